@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+"""
+Benchmarks of the read and write paths of Py3ID3
+Synthetic mp3 files are generated locally for every combination of
+ID3 version, picture and file size, after which the common operations
+of the gui and command line are timed on them:
+opening the files and combining the values, converting the version,
+replacing or keeping the picture and numbering the tracks
+Every operation gets a newly generated corpus and runs in a new process,
+so it measures files of the given version, and on Linux its own peak memory
+The results are printed as JSON, with the throughput and peak memory
+"""
+
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import struct
+import sys
+import tempfile
+import time
+import zlib
+
+import stagger
+
+from tagbatch import (
+    DEFAULT_WORKERS,
+    EditSpec,
+    TagBatch,
+    aggregate,
+    read_records)
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, the peak memory is left out there
+    resource = None
+
+# Size of the audio after the tag in bytes, one mp3 frame header is added
+SIZES = {"tiny": 1024, "small": 256 * 1024, "large": 8 * 1024 * 1024}
+# Size of the picture data in the tag in bytes
+ART = {"none": 0, "large": 512 * 1024}
+# Operations in the order they run, each one on a corpus of its own
+OPERATIONS = ("open", "convert", "picture_keep", "picture_replace", "number")
+# Header of an MPEG-1 Layer III frame, enough for the mp3 detection
+FRAME_HEADER = b"\xff\xfb\x90\x00"
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="benchmark",
+        description="Time the read and write paths on synthetic mp3 files "
+                    "and print the results as JSON.")
+    parser.add_argument(
+        "--files",
+        type=int,
+        nargs="+",
+        default=[100],
+        help="number of files per corpus, for example 100 10000 100000 "
+             "(default: 100)")
+    parser.add_argument(
+        "--versions",
+        type=int,
+        nargs="+",
+        choices=(2, 3, 4),
+        default=[2, 3, 4],
+        help="ID3 versions of the generated tags (default: 2 3 4)")
+    parser.add_argument(
+        "--art",
+        nargs="+",
+        choices=ART,
+        default=list(ART),
+        help="picture in the generated tags (default: none large)")
+    parser.add_argument(
+        "--sizes",
+        nargs="+",
+        choices=SIZES,
+        default=["tiny"],
+        help="size of the audio of the generated files (default: tiny)")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=DEFAULT_WORKERS,
+        help="number of files written in parallel (default: {})".format(
+            DEFAULT_WORKERS))
+    parser.add_argument(
+        "--dir",
+        help="folder in which the corpora are generated, "
+             "each one is removed after use (default: the temp folder)")
+    parser.add_argument(
+        "--output",
+        help="write the JSON to this file instead of stdout")
+    return parser.parse_args(argv)
+
+
+def png(size=64):
+    """
+    Returns the data of a valid grey png image of size by size pixels
+    """
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(
+            ">I", zlib.crc32(kind + data))
+    rows = b"".join(b"\x00" + b"\x80" * 3 * size for _ in range(size))
+    return b"\x89PNG\r\n\x1a\n" + chunk(
+        b"IHDR", struct.pack(">IIBBBBB", size, size, 8, 2, 0, 0, 0)
+    ) + chunk(b"IDAT", zlib.compress(rows)) + chunk(b"IEND", b"")
+
+
+def picture_frame(version, data):
+    """
+    Returns a front cover frame for the ID3 version with the data as jpeg
+    """
+    if version == 2:
+        return stagger.id3.PIC(
+            encoding=0, format="JPG", type=3, desc="", data=data)
+    return stagger.id3.APIC(
+        encoding=0, mime="image/jpeg", type=3, desc="", data=data)
+
+
+def write_mp3(file, tag, size="tiny"):
+    """
+    Write an mp3 file with the tag and audio of the size (see SIZES)
+    Returns the number of bytes written
+    """
+    with open(file, "wb") as f:
+        return f.write(tag.encode()) + f.write(
+            FRAME_HEADER + bytes(SIZES[size]))
+
+
+def generate(folder, count, version, art, size):
+    """
+    Generate count mp3 files with a tag of the version in the folder
+    Every file has its own title and track, the rest is shared
+    Returns the sorted list of files and their total size in bytes
+    """
+    tag_class = {
+        2: stagger.tags.Tag22,
+        3: stagger.tags.Tag23,
+        4: stagger.tags.Tag24}[version]
+    picture = None
+    if ART[art]:
+        picture = picture_frame(version, os.urandom(ART[art]))
+    files = []
+    total = 0
+    for number in range(count):
+        tag = tag_class()
+        tag.title = "Title {}".format(number)
+        tag.artist = "Artist"
+        tag.album = "Album {}".format(number // 12)
+        tag.date = "2001"
+        tag.genre = "Synthetic"
+        tag.track = number % 12 + 1
+        if picture:
+            tag[picture.frameid] = [picture]
+        file = os.path.join(folder, "{:06}.mp3".format(number))
+        total += write_mp3(file, tag, size)
+        files.append(file)
+    return files, total
+
+
+def peak_memory():
+    """
+    Returns the peak resident memory of the process in KiB (if known)
+    On Linux this is VmHWM of /proc, as ru_maxrss keeps the peak of the
+    parent process after a fork, the process then reports that instead
+    Elsewhere ru_maxrss is used, which can include the parent's peak
+    """
+    try:
+        with open("/proc/self/status", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        # macOS reports bytes instead of KiB
+        peak //= 1024
+    return peak
+
+
+def operation_spec(name, version, picture):
+    """
+    Returns the EditSpec of an operation, or None for opening the files
+    """
+    if name == "convert":
+        # Convert to the next version, so every file is changed
+        return EditSpec(version={2: 3, 3: 4, 4: 2}[version])
+    if name == "picture_keep":
+        return EditSpec(fields={"comment": "Kept picture"})
+    if name == "picture_replace":
+        return EditSpec(picture=picture)
+    if name == "number":
+        return EditSpec(numbering=True, padding=True)
+    return None
+
+
+def run_operation(name, files, version, picture, workers):
+    """
+    Run a single operation on the files
+    Returns the number of failed files
+    """
+    spec = operation_spec(name, version, picture)
+    if spec is None:
+        records = []
+        failed = 0
+        for _, record, error in read_records(files):
+            if error:
+                failed += 1
+            else:
+                records.append(record)
+        aggregate(records)
+        return failed
+    return len(TagBatch(files, spec, workers).write())
+
+
+def measure_operation(name, files, version, picture, workers):
+    """
+    Time a single operation, in a process of its own (see benchmark_corpus)
+    Returns the seconds, the number of failed files,
+    and the peak memory before and after the operation
+    """
+    baseline = peak_memory()
+    start = time.perf_counter()
+    failed = run_operation(name, files, version, picture, workers)
+    seconds = time.perf_counter() - start
+    return seconds, failed, baseline, peak_memory()
+
+
+def benchmark_corpus(parent, count, version, art, size, workers):
+    """
+    Time every operation on a corpus that's generated in the parent folder,
+    the corpus is generated again for each operation,
+    as the earlier operations change the files, for example the version
+    Returns a list of result dicts, one per operation
+    """
+    # A new interpreter, so the operation doesn't share the parent's memory
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for name in OPERATIONS:
+        with tempfile.TemporaryDirectory(dir=parent) as folder:
+            picture = os.path.join(folder, "cover.png")
+            with open(picture, "wb") as f:
+                f.write(png())
+            start = time.perf_counter()
+            files, total = generate(folder, count, version, art, size)
+            generated = time.perf_counter() - start
+            with concurrent.futures.ProcessPoolExecutor(
+                    max_workers=1, mp_context=context) as pool:
+                seconds, failed, baseline, peak = pool.submit(
+                    measure_operation,
+                    name,
+                    files,
+                    version,
+                    picture,
+                    workers).result()
+        results.append({
+            "operation": name,
+            "files": count,
+            "version": version,
+            "art": art,
+            "size": size,
+            "workers": workers,
+            "corpus_bytes": total,
+            "generate_seconds": round(generated, 6),
+            "seconds": round(seconds, 6),
+            "files_per_second": round(count / seconds, 2) if seconds else None,
+            "megabytes_per_second": round(
+                total / 1024 / 1024 / seconds, 2) if seconds else None,
+            "failed": failed,
+            "baseline_rss_kib": baseline,
+            "peak_rss_kib": peak})
+    return results
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = []
+    for count in args.files:
+        for version in args.versions:
+            for art in args.art:
+                for size in args.sizes:
+                    results.extend(benchmark_corpus(
+                        args.dir, count, version, art, size, args.workers))
+                    print("Finished {} files, v2.{}, {} art, {} size".format(
+                        count, version, art, size), file=sys.stderr)
+    report = {
+        "python": sys.version.split()[0],
+        "platform": sys.platform,
+        "results": results}
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
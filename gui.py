@@ -0,0 +1,726 @@
+"""
+Tk gui of Py3ID3, started by py3id3.py when no files are given
+It's a thin client on top of tagbatch.py
+"""
+
+import functools
+import queue
+import threading
+import tkinter as tk
+import webbrowser
+
+from tkinter import messagebox
+from tkinter import filedialog
+from tkinter import Menu
+from tkinter import ttk
+
+from tagbatch import (
+    DEFAULT_WORKERS,
+    ID3_FIELDS,
+    EditSpec,
+    FileSet,
+    TagBatch,
+    RecordCache,
+    aggregate,
+    numbering_preview,
+    read_records,
+    scan_files,
+    unique_files)
+
+# A dictionary of Field objects
+# Field class is found at the end of this file
+FIELDS = {}
+
+# An ordered set of opened files
+FILES = FileSet()
+
+# Milliseconds between the checks for progress of a background task
+POLL_INTERVAL = 100
+# Maximum number of warnings or failed files listed in a popup
+MESSAGE_LIMIT = 30
+
+
+def summarize(lines, limit=MESSAGE_LIMIT):
+    """
+    Join the lines of a message, only showing the first ones if there
+    are more than the limit, to keep the popup on the screen
+    """
+    if len(lines) > limit:
+        lines = lines[:limit] + ["... and {} more".format(len(lines) - limit)]
+    return "".join("{}\n".format(line) for line in lines)
+
+
+def close_window_callback(root):
+    """
+    Close the window if that's requested
+    Ask for a confirmation if files have been opened
+    """
+    if not FILES:
+        root.destroy()
+    elif messagebox.askokcancel("Quit", "Do you really wish to quit?"):
+        root.destroy()
+
+
+class Application:
+    """
+    Main application class
+    """
+    def __init__(self, root, version, index=None):
+        # Init
+        self.app_version = version
+        # Optional TagIndex, so unchanged files are not parsed at all
+        self.index = index
+        self.frame = tk.Frame(root)
+        self.frame.pack()
+        # Compact records of the opened files, used for the original values
+        self.records = RecordCache()
+        # Reading and writing is done in the background, one task at a time
+        self.busy = False
+        self.task_queue = queue.Queue()
+        self.task_cancel = None
+        # Menu bar
+        menubar = Menu(root)
+        # File menu
+        file_menu = Menu(menubar, tearoff=0)
+        file_menu.add_command(label="Open", command=self.browse_files_popup)
+        file_menu.add_command(
+            label="Open folder",
+            command=self.browse_folder_popup)
+        self.check_magic = tk.IntVar()
+        file_menu.add_checkbutton(
+            label="Only mp3 contents in folders",
+            variable=self.check_magic)
+        file_menu.add_command(label="List", command=self.list_files_popup)
+        file_menu.add_command(label="About", command=self.about_popup)
+        file_menu.add_command(
+            label="Exit",
+            command=lambda: close_window_callback(root))
+        menubar.add_cascade(label="File", menu=file_menu)
+        # Convert menu
+        write_menu = Menu(menubar, tearoff=0)
+        write_menu.add_command(
+            label="As v2.2",
+            command=lambda: self.write_tags(2))
+        write_menu.add_command(
+            label="As v2.3",
+            command=lambda: self.write_tags(3))
+        write_menu.add_command(
+            label="As v2.4",
+            command=lambda: self.write_tags(4))
+        write_menu.add_command(
+            label="As original",
+            command=lambda: self.write_tags(0))
+        menubar.add_cascade(label="Write", menu=write_menu)
+        root.config(menu=menubar)
+        # Add the fields to the frame
+        self.create_fields()
+        root.bind("<Control-q>", lambda e: close_window_callback(root))
+        root.bind("<Control-Q>", lambda e: close_window_callback(root))
+
+    def browse_files_popup(self):
+        """
+        Show a file browser and expand the list of files
+        Duplicates won't be added, also not through links (see read_task)
+        Menu: File > Open
+        """
+        if self.busy:
+            return
+        self.files_opened = []
+        # Limit the selection to mp3 only
+        self.files_opened = filedialog.askopenfilenames(
+            filetypes=(("Mp3 files", "*.mp3"),))
+        # If any files were opened, add them to files
+        if self.files_opened:
+            # Only new files are added, to prevent duplicates
+            # Update the list of old values
+            self.update_fields(self.files_opened)
+
+    def browse_folder_popup(self):
+        """
+        Show a folder browser and add all mp3 files inside it
+        Subfolders are included and duplicates won't be added
+        With File > Only mp3 contents in folders, the files are checked
+        to start like an mp3, otherwise only the extension is checked
+        Menu: File > Open folder
+        """
+        if self.busy:
+            return
+        folder = filedialog.askdirectory()
+        if folder:
+            # The folder is scanned in the background as well
+            self.update_fields(scan_files(
+                [folder], magic=bool(self.check_magic.get())))
+
+    def list_files_popup(self):
+        """
+        Show a popup with the list of opened files
+        Menu: File > List
+        """
+        file_list = ""
+        for file in FILES:
+            file_list += "{}\n".format(file)
+        if file_list:
+            Popup(self.frame, "Files", file_list)
+        else:
+            Popup(self.frame, "Files", "No files have been opened yet\n")
+
+    def about_popup(self):
+        """
+        Show a popup with details about the program
+        Menu: File > About
+        """
+        Popup(
+            self.frame,
+            "About",
+            "Py3ID3 {}\n"
+            "Created by Jelmerro\n"
+            "MIT License\n".format(self.app_version),
+            15,
+            "Github",
+            "https://github.com/Jelmerro/py3id3",
+            13)
+
+    def write_tags(self, requested_version):
+        """
+        Read the tags and write them to each file in the background
+        A list of failed files will be shown afterwards
+        Menu: All options in "Write"
+        """
+        if self.busy:
+            return
+        batch = TagBatch(
+            list(FILES),
+            self.edit_spec(requested_version),
+            workers=DEFAULT_WORKERS,
+            records=self.records)
+        self.start_task(
+            "Writing tags",
+            lambda report: self.write_task(batch, report),
+            self.write_done,
+            batch.cancelled)
+
+    def write_task(self, batch, report):
+        """
+        Write all files of the batch, runs in the background
+        """
+        report("total", len(batch.files))
+        skipped = {}
+        processed = 0
+        for file, error in batch.results():
+            if error:
+                skipped[file] = error
+            processed += 1
+            report("progress", processed)
+        return batch, skipped, processed
+
+    def write_done(self, result):
+        batch, skipped, processed = result
+        self.show_results(skipped, batch.rewrites, batch.unchanged, processed)
+
+    def edit_spec(self, requested_version):
+        """
+        Returns the EditSpec matching the current settings of the fields
+        """
+        fields = {}
+        for field in ID3_FIELDS:
+            if field not in ["track", "track_total"]:
+                if FIELDS[field].checked():
+                    fields[field] = FIELDS[field].text()
+        picture = None
+        if self.picture_enabled_var.get():
+            picture = self.picture_var.get()
+        return EditSpec(
+            fields=fields,
+            numbering=FIELDS["track"].checked(),
+            padding=FIELDS["track_total"].checked(),
+            picture=picture,
+            keep_obscure=bool(self.keep_obscure.get()),
+            version=requested_version)
+
+    def show_results(self, skipped, rewrites=0, unchanged=0, processed=None):
+        """
+        Show a popup with the list of failed files (if any)
+        Also shows the number of processed files,
+        how many of them had to be rewritten completely,
+        and how many were skipped because they were already up to date
+        """
+        if processed is None:
+            processed = len(FILES)
+        success_number = processed - len(skipped)
+        failed = ["{} - {}".format(file, error)
+                  for file, error in skipped.items()]
+        if FILES:
+            message = ""
+            if processed < len(FILES):
+                message = "Cancelled after {} of the {} files\n".format(
+                    processed,
+                    len(FILES))
+            if processed and success_number == 0:
+                message += "All {} files failed:\n".format(processed)
+                message += summarize(failed)
+            elif skipped:
+                message += "{} of the {} succeeded, but some failed:\n".format(
+                    success_number,
+                    processed)
+                message += summarize(failed)
+            elif processed:
+                message += "Replaced tags for all {} files " \
+                           "with success\n".format(processed)
+            if rewrites:
+                message += "{} of the files needed a full rewrite\n".format(
+                    rewrites)
+            if unchanged:
+                message += "{} of the files were already up to date\n".format(
+                    unchanged)
+        else:
+            message = "No files have been opened yet\n"
+        Popup(self.frame, "Done", message)
+        # Update the fields afterwards
+        self.update_fields()
+
+    def start_task(self, label, work, done, cancel):
+        """
+        Run work in a background thread, so the window stays responsive
+        work gets a report function, to send the "total" number of files
+        and the "progress" to the window, which checks for them with after
+        cancel is the threading.Event that's set by the cancel button
+        done is called with the result of work on the main thread
+        """
+        self.busy = True
+        self.task_cancel = cancel
+        self.task_label_var.set(label)
+        self.task_progress["value"] = 0
+        self.task_progress["maximum"] = 1
+        self.cancel_button.config(state=tk.NORMAL)
+        thread = threading.Thread(
+            target=self.run_task,
+            args=(work,),
+            daemon=True)
+        thread.start()
+        self.frame.after(POLL_INTERVAL, self.poll_task, done)
+
+    def run_task(self, work):
+        """
+        Runs in the background thread, never touches the widgets
+        """
+        try:
+            result = work(lambda kind, value: self.task_queue.put(
+                (kind, value)))
+            self.task_queue.put(("done", result))
+        except Exception as e:
+            self.task_queue.put(("error", e))
+
+    def poll_task(self, done):
+        """
+        Show the progress of the background task and finish it when done
+        """
+        while True:
+            try:
+                kind, value = self.task_queue.get_nowait()
+            except queue.Empty:
+                break
+            if kind == "total":
+                self.task_progress["maximum"] = max(value, 1)
+            elif kind == "progress":
+                self.task_progress["value"] = value
+            else:
+                self.busy = False
+                self.task_cancel = None
+                self.task_label_var.set("")
+                self.task_progress["value"] = 0
+                self.cancel_button.config(state=tk.DISABLED)
+                if kind == "done":
+                    done(value)
+                else:
+                    Popup(self.frame, "Error", "{}\n".format(value))
+                return
+        self.frame.after(POLL_INTERVAL, self.poll_task, done)
+
+    def cancel_task(self, event=None):
+        """
+        Cancel the background task, files that are busy will be finished
+        """
+        if self.task_cancel:
+            self.task_cancel.set()
+            self.task_label_var.set("Cancelling")
+
+    def create_fields(self):
+        """
+        Creates a label, checkbox and textfields
+        Every field in the tag will have them
+        """
+        # regular fields
+        row = 1
+        for field in ID3_FIELDS:
+            FIELDS[field] = Field(field, row, self.frame)
+            row += 1
+        # special fields
+        version_frame = tk.Frame(self.frame)
+        version_frame.grid(column=1, row=row)
+        # version field
+        self.version_label = tk.Label(self.frame, text="ID3 Version")
+        self.version_label.grid(column=0, row=row)
+        self.version_var = tk.StringVar()
+        self.version = tk.Entry(
+            version_frame,
+            width=50,
+            state=tk.DISABLED,
+            textvariable=self.version_var)
+        self.version.grid(column=0, row=0)
+        # version settings
+        keep_obscure_frame = tk.Frame(version_frame)
+        keep_obscure_frame.grid(column=0, row=1)
+        self.keep_obscure = tk.IntVar()
+        check = tk.Checkbutton(
+            keep_obscure_frame,
+            variable=self.keep_obscure)
+        check.grid(column=0, row=0)
+        label = tk.Label(
+            keep_obscure_frame,
+            text="Keep obscure tags, converted if the ID3 version changes")
+        label.grid(column=1, row=0)
+        # picture settings
+        self.picture_enabled_var = tk.IntVar()
+        self.picture_enabled = tk.Checkbutton(
+            self.frame,
+            variable=self.picture_enabled_var)
+        self.picture_enabled.grid(column=2, row=row)
+        self.picture_enabled.bind("<Button-1>", self.update_picture)
+        self.picture_enabled.bind("<Return>", self.update_picture)
+        self.picture_enabled.bind("<space>", self.update_picture)
+        picture_settings_frame = tk.Frame(self.frame)
+        picture_settings_frame.grid(column=3, row=row)
+        browse_button = tk.Button(picture_settings_frame, text="Browse")
+        browse_button.grid(column=0, row=0)
+        browse_button.bind("<Button-1>", self.open_picture)
+        browse_button.bind("<Return>", self.open_picture)
+        browse_button.bind("<space>", self.open_picture)
+        self.picture_var = tk.StringVar()
+        self.picture = tk.Entry(
+            picture_settings_frame,
+            width=30,
+            state=tk.DISABLED,
+            textvariable=self.picture_var)
+        self.picture.grid(column=1, row=0)
+        self.picture_status_var = tk.StringVar()
+        self.picture_status_var.set("All files will keep the current picture")
+        picture_status = tk.Label(
+            picture_settings_frame,
+            textvariable=self.picture_status_var)
+        picture_status.grid(column=1, row=1)
+        clear_button = tk.Button(picture_settings_frame, text="Clear")
+        clear_button.grid(column=2, row=0)
+        clear_button.bind("<Button-1>", self.clear_picture)
+        clear_button.bind("<Return>", self.clear_picture)
+        clear_button.bind("<space>", self.clear_picture)
+        # progress of reading and writing
+        row += 1
+        self.task_label_var = tk.StringVar()
+        task_label = tk.Label(self.frame, textvariable=self.task_label_var)
+        task_label.grid(column=0, row=row)
+        self.task_progress = ttk.Progressbar(
+            self.frame,
+            length=300,
+            mode="determinate")
+        self.task_progress.grid(column=1, row=row)
+        self.cancel_button = tk.Button(
+            self.frame,
+            text="Cancel",
+            state=tk.DISABLED,
+            command=self.cancel_task)
+        self.cancel_button.grid(column=3, row=row)
+
+    def clear_picture(self, event=None):
+        """
+        Clears the picture field
+        """
+        self.picture_var.set("")
+        self.update_picture()
+
+    def open_picture(self, event=None):
+        if event:
+            event.widget.after_idle(self.open_picture_callback)
+        else:
+            self.open_picture_callback()
+
+    def open_picture_callback(self, e=None):
+        """
+        Show a file browser and set the new picture
+        """
+        # Limit the selection to png and jpg only
+        self.file_opened = filedialog.askopenfilename(
+            filetypes=(("PNG files", "*.png"),))
+        # If any files were opened, add them to files
+        if self.file_opened:
+            self.picture_var.set(self.file_opened)
+            self.update_picture()
+
+    def update_picture(self, event=None):
+        if event:
+            event.widget.after_idle(self.update_picture_callback)
+        else:
+            self.update_picture_callback()
+
+    def update_picture_callback(self, e=None):
+        """
+        Update the picture status label to match new the settings
+        """
+        if self.picture_enabled_var.get():
+            if self.picture_var.get():
+                self.picture_status_var.set(
+                    "All files will have this picture added")
+            else:
+                self.picture_status_var.set(
+                    "All files will have the picture removed")
+        else:
+            self.picture_status_var.set(
+                "All files will keep the current picture")
+
+    def update_fields(self, new_files=()):
+        """
+        Update the original values for each field
+        New files are added first, the tags are read in the background
+        """
+        if self.busy:
+            return
+        files = list(FILES)
+        cancel = threading.Event()
+        self.start_task(
+            "Reading tags",
+            lambda report: self.read_task(files, new_files, cancel, report),
+            self.read_done,
+            cancel)
+
+    def read_task(self, files, new_files, cancel, report):
+        """
+        Read the tags and combine the values, runs in the background
+        New files that are not read because of a cancel are not added,
+        opened files are kept, but won't be part of the original values
+        """
+        files = FileSet(files)
+        opened = len(files)
+        files.extend(new_files)
+        # The same file might be opened again through a link
+        duplicates = {}
+        files = FileSet(unique_files(files, duplicates=duplicates))
+        report("total", len(files))
+        remove_list = []
+        warnings = ["duplicate file: {} is the same as {}".format(
+            file, original) for file, original in duplicates.items()]
+        records = []
+        if self.index is None:
+            reader = read_records(files, self.records)
+        else:
+            reader = self.index.read_records(files, self.records)
+        for number, (file, record, error) in enumerate(reader):
+            if cancel.is_set():
+                not_added = files[max(number, opened):]
+                remove_list.extend(not_added)
+                warnings.append("Cancelled, the original values are "
+                                "incomplete and {} files were not "
+                                "added".format(len(not_added)))
+                break
+            if error:
+                warnings.append(error)
+                remove_list.append(file)
+            if record:
+                records.append(record)
+            report("progress", number + 1)
+        files.remove_all(remove_list)
+        return files, aggregate(records), warnings
+
+    def read_done(self, result):
+        """
+        Show the values that were read, every widget is only set once
+        """
+        files, originals, warnings = result
+        FILES.clear()
+        FILES.extend(files)
+        for field in ID3_FIELDS:
+            FIELDS[field].set_original(originals[field])
+        self.version_var.set(originals["version"])
+        if FILES:
+            for field in ID3_FIELDS:
+                FIELDS[field].update_output()
+        if warnings:
+            Popup(self.frame, "Warning", summarize(warnings))
+
+
+class Popup:
+    """
+    Popup class creates a toplevel with labels
+    It's not resizable, grabs the focus and stays on top
+    Optionally adds a link to it
+    """
+    def __init__(self,
+                 frame,
+                 title,
+                 message,
+                 size=12,
+                 link_title=None,
+                 link=None,
+                 link_size=None):
+        popup = tk.Toplevel(frame, padx="40", pady="40")
+        # Add a link if provided
+        if link_title:
+            label = tk.Label(popup, text=message, font="-size {}".format(size))
+            label.grid(row=0)
+            link_label = tk.Label(
+                popup,
+                text=link_title,
+                fg="blue",
+                cursor="hand2",
+                font="-size {}".format(link_size))
+            link_label.bind(
+                "<Button-1>",
+                lambda e: webbrowser.open_new(link))
+            link_label.grid(row=1)
+        else:
+            tk.Label(popup, text=message, font="-size {}".format(size)).pack()
+        popup.grab_set()
+        popup.title(title)
+        popup.resizable(False, False)
+        popup.wm_attributes("-topmost", True)
+        popup.bind("<Escape>", lambda e: popup.destroy())
+
+
+class Field(tk.Frame):
+    """
+    Field class consists of a label, checkbox and three entry fields
+    A field will occupy a single row in the application
+    For every id3 field, a Field object will be created
+    (except for the picture and version)
+    """
+    def __init__(self, name, row, master):
+        self.name = name
+        self.master = master
+        self.update_pending = False
+        super(Field, self).__init__(master=master)
+        # label - title Label
+        self.label = tk.Label(self.master, text=self.title(name))
+        self.label.grid(column=0, row=row)
+        # original - old Entry
+        self.old_var = tk.StringVar()
+        self.old = tk.Entry(
+            self.master,
+            width=50,
+            state=tk.DISABLED,
+            textvariable=self.old_var)
+        self.old.grid(column=1, row=row)
+        # checkbox - enabled Checkbutton
+        self.checkbox_var = tk.IntVar()
+        self.checkbox = tk.Checkbutton(
+            self.master,
+            variable=self.checkbox_var)
+        self.checkbox.grid(column=2, row=row)
+        self.checkbox.bind("<Button-1>", self.update_output)
+        self.checkbox.bind("<Return>", self.update_output)
+        self.checkbox.bind("<space>", self.update_output)
+        # entry - input Entry
+        if name not in ["track", "track_total"]:
+            self.input_var = tk.StringVar()
+            self.input = tk.Entry(
+                self.master,
+                width=50,
+                textvariable=self.input_var)
+            self.input.grid(column=3, row=row)
+            self.input.bind("<Any-KeyPress>", self.update_output)
+        elif name == "track":
+            self.input = tk.Label(
+                self.master,
+                text="Automatically number the tracks")
+            self.input.grid(column=3, row=row)
+        elif name == "track_total":
+            self.input = tk.Label(
+                self.master,
+                text="Pad zeros to match the total number of tracks")
+            self.input.grid(column=3, row=row)
+        # output - new Entry
+        self.output_var = tk.StringVar()
+        self.output = tk.Entry(
+            self.master,
+            width=50,
+            state=tk.DISABLED,
+            textvariable=self.output_var)
+        self.output.grid(column=4, row=row)
+
+    def title(self, text):
+        return text.title().replace("_", " ")
+
+    def set_original(self, text):
+        self.old_var.set(text)
+
+    def clear_original(self):
+        self.old_var.set("")
+
+    def original(self):
+        return self.old_var.get()
+
+    def checked(self):
+        return bool(self.checkbox_var.get())
+
+    def text(self):
+        return self.input_var.get()
+
+    def set_output(self, text):
+        self.output_var.set(text)
+
+    def update_output(self, event=None):
+        if event:
+            # Fast typing schedules only one update until it has run
+            if not self.update_pending:
+                self.update_pending = True
+                event.widget.after_idle(self.update_output_callback)
+        else:
+            self.update_output_callback()
+
+    def update_output_callback(self):
+        """
+        Update the output fields to match the new settings
+        Only this field is updated, or both numbering fields
+        """
+        self.update_pending = False
+        if self.name in ["track", "track_total"]:
+            if FIELDS["track"].checked():
+                padding = FIELDS["track_total"].checked()
+                track, track_total = self.get_numbering(padding)
+                FIELDS["track"].set_output(track)
+                FIELDS["track_total"].set_output(track_total)
+            else:
+                FIELDS["track"].set_output(FIELDS["track"].original())
+                FIELDS["track_total"].set_output(
+                    FIELDS["track_total"].original())
+        else:
+            if not self.checked():
+                self.set_output(self.original())
+            else:
+                self.set_output(self.text())
+
+    def get_numbering(self, padding):
+        """
+        Returns a formatted string version of the numbering
+        It only depends on the number of files and the padding,
+        so it's only built again when one of those changes
+        """
+        return cached_numbering(len(FILES), padding)
+
+
+@functools.lru_cache(maxsize=4)
+def cached_numbering(count, padding):
+    """
+    Numbering preview of the fields, huge ones are truncated
+    """
+    return numbering_preview(count, padding)
+
+
+def start(version, index=None):
+    """
+    Create a root Tk object and start the application with it
+    The tags are read from the TagIndex if there is one
+    """
+    root = tk.Tk()
+    root.protocol("WM_DELETE_WINDOW", lambda: close_window_callback(root))
+    root.resizable(False, False)
+    root.title("Py3ID3")
+    Application(root, version, index)
+    root.mainloop()
@@ -7,635 +7,469 @@ __license__ = "MIT"
 __version__ = "0.2.1"
 # See Jelmerro/py3id3 on github for updates
 
-import os
-import stagger
-import tkinter as tk
-import webbrowser
-
-from tkinter import messagebox
-from tkinter import filedialog
-from tkinter import Menu
-
-# The ID3 fields
-ID3_FIELDS = (
-    "title",
-    "artist",
-    "date",
-    "album_artist",
-    "album",
-    "track",
-    "track_total",
-    "disc",
-    "disc_total",
-    "composer",
-    "genre",
-    "comment",
-    "grouping")
-# Picture and version are special fields
-# They are implemented differently
-
-# A dictionary of Field objects
-# Field class is found at the end of this file
-FIELDS = {}
-
-# A list of opened files
-FILES = []
-
-
-def close_window_callback(root):
+import argparse
+import json
+import sys
+
+from tagbatch import (
+    DEDUP_MODES,
+    DEFAULT_CHUNK_SIZE,
+    DEFAULT_RESERVE,
+    DEFAULT_WORKERS,
+    ID3_FIELDS,
+    BatchJournal,
+    BatchMetrics,
+    EditSpec,
+    FieldTemplate,
+    FileSet,
+    IOScheduler,
+    PathPattern,
+    RecordCache,
+    TagBatch,
+    chunked,
+    scan_files,
+    unique_files,
+    write_report)
+from tagindex import TagIndex
+
+# Values of --as and the matching requested versions
+WRITE_AS = {"2.2": 2, "2.3": 3, "2.4": 4, "original": 0}
+
+
+def parse_args(argv=None):
     """
-    Close the window if that's requested
-    Ask for a confirmation if files have been opened
+    Parse the command line arguments
+    The options match the fields and settings of the gui
     """
-    if not FILES:
-        root.destroy()
-    elif messagebox.askokcancel("Quit", "Do you really wish to quit?"):
-        root.destroy()
-
-
-class Application:
+    parser = argparse.ArgumentParser(
+        prog="py3id3",
+        description="The mp3 tagger with no hidden magic. "
+                    "Without any files the gui is started, "
+                    "otherwise the changes are written to all files.")
+    parser.add_argument(
+        "files",
+        nargs="*",
+        help="mp3 files, folders or glob patterns, use - to read them "
+             "from stdin (one per line)")
+    parser.add_argument(
+        "--check-magic",
+        action="store_true",
+        help="skip the files that don't start with an ID3 tag or mp3 audio, "
+             "instead of reporting them as failed")
+    parser.add_argument(
+        "--version",
+        action="version",
+        version="Py3ID3 {}".format(__version__))
+    fields = parser.add_argument_group(
+        "fields",
+        "Only the given fields are changed, an empty text removes it")
+    for field in ID3_FIELDS:
+        if field not in ["track", "track_total"]:
+            fields.add_argument(
+                "--{}".format(field.replace("_", "-")),
+                dest=field,
+                metavar="TEXT")
+    fields.add_argument(
+        "--number",
+        action="store_true",
+        help="automatically number the tracks")
+    fields.add_argument(
+        "--pad",
+        action="store_true",
+        help="pad zeros to match the total number of tracks")
+    picture = fields.add_mutually_exclusive_group()
+    picture.add_argument(
+        "--picture",
+        metavar="PNG",
+        help="add this picture to all files")
+    picture.add_argument(
+        "--clear-picture",
+        action="store_true",
+        help="remove the picture of all files")
+    templates = parser.add_argument_group(
+        "templates",
+        "Values per file, they are combined with the fields above")
+    templates.add_argument(
+        "--group",
+        metavar="FIELD",
+        help="with --number, number the tracks per folder (use folder) "
+             "or per value of a field, for example album")
+    templates.add_argument(
+        "--discs",
+        action="store_true",
+        help="with --number, number the discs by folder within a group")
+    templates.add_argument(
+        "--pattern",
+        help="take values from the end of the path, for example "
+             "{artist}/{album}/{track} - {title}, use {_} to skip a part")
+    templates.add_argument(
+        "--template",
+        action="append",
+        default=[],
+        metavar="FIELD=TEMPLATE",
+        help="set a field from a template, for example "
+             "title=\"{artist} - {title}\", any field and {filename} "
+             "or {folder} can be used, can be given multiple times")
+    version = parser.add_argument_group("version")
+    version.add_argument(
+        "--as",
+        dest="write_as",
+        choices=WRITE_AS,
+        default="original",
+        help="ID3 version of the new tags (default: original)")
+    version.add_argument(
+        "--keep-obscure",
+        action="store_true",
+        help="keep obscure tags, converted if the ID3 version changes")
+    batch = parser.add_argument_group("batch")
+    batch.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="don't write anything, but print the changes per file "
+             "as JSON Lines, unchanged files are left out")
+    batch.add_argument(
+        "--dedup",
+        choices=DEDUP_MODES,
+        help="skip files that are the same file as an earlier one, "
+             "such as links, or also files with the same audio, "
+             "the skipped files are listed afterwards")
+    batch.add_argument(
+        "--workers",
+        type=int,
+        default=DEFAULT_WORKERS,
+        help="number of files written in parallel (default: {})".format(
+            DEFAULT_WORKERS))
+    batch.add_argument(
+        "--processes",
+        action="store_true",
+        help="use worker processes instead of threads")
+    batch.add_argument(
+        "--reserve",
+        type=int,
+        default=DEFAULT_RESERVE,
+        metavar="BYTES",
+        help="padding added when a file has to be rewritten "
+             "(default: {})".format(DEFAULT_RESERVE))
+    batch.add_argument(
+        "--chunk-size",
+        type=int,
+        default=DEFAULT_CHUNK_SIZE,
+        help="number of files that are scanned before writing them "
+             "(default: {})".format(DEFAULT_CHUNK_SIZE))
+    batch.add_argument(
+        "--max-open",
+        type=int,
+        metavar="FILES",
+        help="maximum number of files that are open at the same time, "
+             "the files are then also handled per folder in disk order, "
+             "the limit is divided over the processes with --processes")
+    batch.add_argument(
+        "--max-rate",
+        type=int,
+        metavar="BYTES",
+        help="maximum bytes read and written per second on average, "
+             "to leave room for other traffic on network storage, "
+             "the limit is divided over the processes with --processes")
+    batch.add_argument(
+        "--journal",
+        metavar="FILE",
+        help="record the progress in this file, so an interrupted run "
+             "continues where it stopped when started again with it, "
+             "the file is removed once all files are processed")
+    batch.add_argument(
+        "--metrics",
+        metavar="FILE",
+        help="write the timings per phase and the counters to this file "
+             "in the Prometheus text format, or as JSON for a .json file, "
+             "a dry run only has the read and build phases")
+    index = parser.add_argument_group(
+        "index",
+        "Keep the tags of a library in a local file, so unchanged files "
+        "are not read again, both by the gui and the command line")
+    index.add_argument(
+        "--index",
+        metavar="FILE",
+        help="SQLite index that is updated with the given files")
+    index.add_argument(
+        "--find",
+        action="append",
+        default=[],
+        metavar="FIELD=VALUE",
+        help="print the indexed files with this value instead of writing, "
+             "can be given multiple times to match all of them")
+    args = parser.parse_args(argv)
+    args.find = find_fields(parser, args)
+    args.template = template_fields(parser, args)
+    for option, minimum in (("max_open", 1),
+                            ("max_rate", 1),
+                            ("chunk_size", 1),
+                            ("reserve", 0)):
+        value = getattr(args, option)
+        if value is not None and value < minimum:
+            parser.error("--{} must be at least {}".format(
+                option.replace("_", "-"), minimum))
+    return args
+
+
+def template_fields(parser, args):
     """
-    Main application class
+    Returns a dict of the --template fields and templates,
+    the templates and the --pattern are checked right away
     """
-    def __init__(self, root):
-        # Init
-        self.frame = tk.Frame(root)
-        self.frame.pack()
-        # Menu bar
-        menubar = Menu(root)
-        # File menu
-        file_menu = Menu(menubar, tearoff=0)
-        file_menu.add_command(label="Open", command=self.browse_files_popup)
-        file_menu.add_command(label="List", command=self.list_files_popup)
-        file_menu.add_command(label="About", command=self.about_popup)
-        file_menu.add_command(
-            label="Exit",
-            command=lambda: close_window_callback(root))
-        menubar.add_cascade(label="File", menu=file_menu)
-        # Convert menu
-        write_menu = Menu(menubar, tearoff=0)
-        write_menu.add_command(
-            label="As v2.2",
-            command=lambda: self.write_tags(2))
-        write_menu.add_command(
-            label="As v2.3",
-            command=lambda: self.write_tags(3))
-        write_menu.add_command(
-            label="As v2.4",
-            command=lambda: self.write_tags(4))
-        write_menu.add_command(
-            label="As original",
-            command=lambda: self.write_tags(0))
-        menubar.add_cascade(label="Write", menu=write_menu)
-        root.config(menu=menubar)
-        # Add the fields to the frame
-        self.create_fields()
-        root.bind("<Control-q>", lambda e: close_window_callback(root))
-        root.bind("<Control-Q>", lambda e: close_window_callback(root))
-
-    def browse_files_popup(self):
-        """
-        Show a file browser and expand the list of files
-        Duplicates won't be added
-        Menu: File > Open
-        """
-        self.files_opened = []
-        # Limit the selection to mp3 only
-        self.files_opened = filedialog.askopenfilenames(
-            filetypes=(("Mp3 files", "*.mp3"),))
-        # If any files were opened, add them to files
-        if self.files_opened:
-            for file in self.files_opened:
-                # Only add new files, to prevent duplicates
-                if file not in FILES:
-                    FILES.append(file)
-            # Update the list of old values
-            self.update_fields()
-
-    def list_files_popup(self):
-        """
-        Show a popup with the list of opened files
-        Menu: File > List
-        """
-        file_list = ""
-        for file in FILES:
-            file_list += "{}\n".format(file)
-        if file_list:
-            Popup(self.frame, "Files", file_list)
+    if (args.group or args.discs) and not args.number:
+        parser.error("--group and --discs need --number")
+    templates = {}
+    try:
+        if args.pattern:
+            PathPattern(args.pattern)
+        for pair in args.template:
+            field, separator, template = pair.partition("=")
+            field = field.replace("-", "_")
+            if field not in ID3_FIELDS or not separator:
+                parser.error("invalid --template {}, expected "
+                             "FIELD=TEMPLATE".format(pair))
+            FieldTemplate(template)
+            templates[field] = template
+    except ValueError as error:
+        parser.error(str(error))
+    if args.group:
+        args.group = args.group.replace("-", "_")
+        if args.group != "folder" and args.group not in ID3_FIELDS:
+            parser.error("invalid --group {}".format(args.group))
+    return templates
+
+
+def find_fields(parser, args):
+    """
+    Returns a dict of the --find fields and values, for TagIndex.find
+    """
+    fields = {}
+    for pair in args.find:
+        field, separator, value = pair.partition("=")
+        field = field.replace("-", "_")
+        if field not in ID3_FIELDS + ("version",) or not separator:
+            parser.error("invalid --find {}, expected FIELD=VALUE".format(
+                pair))
+        fields[field] = value
+    if fields and not args.index:
+        parser.error("--find needs an --index")
+    return fields
+
+
+def edit_spec(args):
+    """
+    Returns the EditSpec for the parsed arguments
+    """
+    fields = {}
+    for field in ID3_FIELDS:
+        if getattr(args, field, None) is not None:
+            fields[field] = getattr(args, field)
+    picture = None
+    if args.clear_picture:
+        picture = ""
+    elif args.picture:
+        picture = args.picture
+    return EditSpec(
+        fields=fields,
+        numbering=args.number,
+        padding=args.pad,
+        picture=picture,
+        keep_obscure=args.keep_obscure,
+        version=WRITE_AS[args.write_as],
+        group=args.group,
+        discs=args.discs,
+        pattern=args.pattern,
+        templates=args.template)
+
+
+def read_paths(paths):
+    """
+    Yield the paths, replacing - by the lines read from stdin
+    """
+    for path in paths:
+        if path == "-":
+            for line in sys.stdin:
+                line = line.rstrip("\r\n")
+                if line:
+                    yield line
         else:
-            Popup(self.frame, "Files", "No files have been opened yet\n")
+            yield path
 
-    def about_popup(self):
-        """
-        Show a popup with details about the program
-        Menu: File > About
-        """
-        Popup(
-            self.frame,
-            "About",
-            "Py3ID3 {}\n"
-            "Created by Jelmerro\n"
-            "MIT License\n".format(__version__),
-            15,
-            "Github",
-            "https://github.com/Jelmerro/py3id3",
-            13)
 
-    def write_tags(self, requested_version):
-        """
-        Read the tags and write them to each file
-        A list of failed files will be shown afterwards
-        Menu: All options in "Write"
-        """
-        skipped = {}
-        for file in FILES:
-            tag = ""
-            try:
-                tag = stagger.read_tag(file)
-            except FileNotFoundError:
-                skipped[file] = "missing file: {}".format(file)
-            except stagger.errors.NoTagError:
-                skipped[file] = "missing id3 tag: {}".format(file)
-            if tag:
-                version = self.file_version(tag.version, requested_version)
-                error = self.write_tag_to_file(tag, file, version)
-                if error:
-                    skipped[file] = error
-        self.show_results(skipped)
+def find(args, index):
+    """
+    Print the indexed files that match all --find values
+    The given files are added to the index first
+    """
+    files = scan_files(read_paths(args.files), magic=args.check_magic)
+    for file, _, error in index.read_records(files):
+        if error:
+            print("{} - {}".format(file, error), file=sys.stderr)
+    for file in index.find(**args.find):
+        print(file)
+    return 0
 
-    def show_results(self, skipped):
-        """
-        Show a popup with the list of failed files (if any)
-        Also shows the number of processed files
-        """
-        success_number = len(FILES) - len(skipped)
-        if FILES:
-            if success_number == 0:
-                message = "All {} files failed:\n".format(len(FILES))
-                for file, error in skipped.items():
-                    message += "{} - {}\n".format(file, error)
-            elif skipped:
-                message = "{} of the {} succeeded, but some failed:\n".format(
-                    success_number,
-                    len(FILES))
-                for file, error in skipped.items():
-                    message += "{} - {}\n".format(file, error)
-            else:
-                message = "Replaced tags for all {} files " \
-                          "with success\n".format(len(FILES))
-        else:
-            message = "No files have been opened yet\n"
-        Popup(self.frame, "Done", message)
-        # Update the fields afterwards
-        self.update_fields()
 
-    def write_tag_to_file(self, old_tag, file, version):
-        """
-        Write the fields to the file as part of a tag
-        Returns the error message (if any)
-        """
-        # Create a tag with the correct version
-        if version not in [0, 2, 3, 4]:
-            return "Invalid version {}".format(version)
-        if version == 0:
-            new_tag = old_tag
-        if version == 2:
-            new_tag = stagger.tags.Tag22()
-        if version == 3:
-            new_tag = stagger.tags.Tag23()
-        if version == 4:
-            new_tag = stagger.tags.Tag24()
-        # Set the regular fields
-        for field in ID3_FIELDS:
-            if field not in ["track", "track_total"]:
-                if FIELDS[field].checked():
-                    try:
-                        setattr(
-                            new_tag,
-                            field,
-                            FIELDS[field].text())
-                    except ValueError or KeyError:
-                        return "Invalid tag error"
-                else:
-                    try:
-                        setattr(
-                            new_tag,
-                            field,
-                            getattr(old_tag, field))
-                    except ValueError or KeyError:
-                        return "Invalid tag error"
-        # Set the numbering if enabled
-        if FIELDS["track"].checked():
-            track_total = len(FILES)
-            track = str(FILES.index(file) + 1)
-            if FIELDS["track_total"].checked():
-                track = track.zfill(len(str(track_total)))
-        else:
-            track_total = getattr(old_tag, "track_total")
-            track = getattr(old_tag, "track")
-        try:
-            setattr(
-                new_tag,
-                "track_total",
-                track_total)
-        except ValueError or KeyError:
-            return "Invalid tag error"
-        try:
-            setattr(
-                new_tag,
-                "track",
-                track)
-        except ValueError or KeyError:
-            return "Invalid tag error"
-        # Picture
-        if self.picture_enabled_var.get():
-            if self.picture_var.get():
-                new_tag.picture = self.picture_var.get()
-            else:
-                new_tag.picture = ""
-        else:
-            picture_data = ""
-            if "PIC" in old_tag:
-                picture_data = old_tag["PIC"][0].data
-            elif "APIC" in old_tag:
-                picture_data = old_tag["APIC"][0].data
-            if picture_data:
-                # This is required, for details see:
-                # https://github.com/lorentey/stagger/issues/48
-                with open("temp_image_file_for_stagger.png", "wb") as f:
-                    f.write(picture_data)
-                new_tag.picture = "temp_image_file_for_stagger.png"
-            else:
-                new_tag.picture = ""
-            try:
-                os.remove("temp_image_file_for_stagger.png")
-            except OSError:
-                pass
-        # Write to file
+def run(args, index=None):
+    """
+    Write the changes to all files and print the failed ones,
+    or only print the changes per file for a dry run
+    The index is updated with the files afterwards, if there is one
+    Returns the exit code, 1 if any of the files failed to write
+    """
+    spec = edit_spec(args)
+    scheduler = None
+    inodes = None
+    if args.max_open or args.max_rate:
+        scheduler = IOScheduler(args.max_open, args.max_rate)
+        inodes = scheduler.inodes
+    files = scan_files(
+        read_paths(args.files), magic=args.check_magic, inodes=inodes)
+    found = None
+    records = None
+    if index is not None:
+        # The files are kept for the index while they're streamed to the batch,
+        # the written tags are stored in it without reading the files again
+        found = FileSet()
+        files = collect(files, found)
+        records = RecordCache()
+    selected = files
+    duplicates = {}
+    if args.dedup:
+        # The audio hashes are kept in the index, if there is one
+        selected = unique_files(files, args.dedup, index, duplicates)
+    executor = "process" if args.processes else "thread"
+    journal = None
+    if args.journal and not args.dry_run:
+        journal = BatchJournal(args.journal)
         try:
-            new_tag.write(file)
-        except FileNotFoundError:
-            return "Write error"
-        return ""
-
-    def file_version(self, tag_version, requested_version):
-        """
-        Calculates the required version for the new tag
-        """
-        # If the versions match and the obscure tags should be kept, return 0
-        if tag_version == requested_version:
-            if self.keep_obscure.get():
-                return 0
-        # If the requested version is not set, keep the original version
-        if requested_version == 0:
-            return tag_version
-        # Else set the version to the requested version
-        return requested_version
-
-    def create_fields(self):
-        """
-        Creates a label, checkbox and textfields
-        Every field in the tag will have them
-        """
-        # regular fields
-        row = 1
-        for field in ID3_FIELDS:
-            FIELDS[field] = Field(field, row, self.frame)
-            row += 1
-        # special fields
-        version_frame = tk.Frame(self.frame)
-        version_frame.grid(column=1, row=row)
-        # version field
-        self.version_label = tk.Label(self.frame, text="ID3 Version")
-        self.version_label.grid(column=0, row=row)
-        self.version_var = tk.StringVar()
-        self.version = tk.Entry(
-            version_frame,
-            width=50,
-            state=tk.DISABLED,
-            textvariable=self.version_var)
-        self.version.grid(column=0, row=0)
-        # version settings
-        keep_obscure_frame = tk.Frame(version_frame)
-        keep_obscure_frame.grid(column=0, row=1)
-        self.keep_obscure = tk.IntVar()
-        check = tk.Checkbutton(
-            keep_obscure_frame,
-            variable=self.keep_obscure)
-        check.grid(column=0, row=0)
-        label = tk.Label(
-            keep_obscure_frame,
-            text="Keep obscure tags for files with unchanged ID3 versions")
-        label.grid(column=1, row=0)
-        # picture settings
-        self.picture_enabled_var = tk.IntVar()
-        self.picture_enabled = tk.Checkbutton(
-            self.frame,
-            variable=self.picture_enabled_var)
-        self.picture_enabled.grid(column=2, row=row)
-        self.picture_enabled.bind("<Button-1>", self.update_picture)
-        self.picture_enabled.bind("<Return>", self.update_picture)
-        self.picture_enabled.bind("<space>", self.update_picture)
-        picture_settings_frame = tk.Frame(self.frame)
-        picture_settings_frame.grid(column=3, row=row)
-        browse_button = tk.Button(picture_settings_frame, text="Browse")
-        browse_button.grid(column=0, row=0)
-        browse_button.bind("<Button-1>", self.open_picture)
-        browse_button.bind("<Return>", self.open_picture)
-        browse_button.bind("<space>", self.open_picture)
-        self.picture_var = tk.StringVar()
-        self.picture = tk.Entry(
-            picture_settings_frame,
-            width=30,
-            state=tk.DISABLED,
-            textvariable=self.picture_var)
-        self.picture.grid(column=1, row=0)
-        self.picture_status_var = tk.StringVar()
-        self.picture_status_var.set("All files will keep the current picture")
-        picture_status = tk.Label(
-            picture_settings_frame,
-            textvariable=self.picture_status_var)
-        picture_status.grid(column=1, row=1)
-        clear_button = tk.Button(picture_settings_frame, text="Clear")
-        clear_button.grid(column=2, row=0)
-        clear_button.bind("<Button-1>", self.clear_picture)
-        clear_button.bind("<Return>", self.clear_picture)
-        clear_button.bind("<space>", self.clear_picture)
-
-    def clear_picture(self, event=None):
-        """
-        Clears the picture field
-        """
-        self.picture_var.set("")
-        self.update_picture()
-
-    def open_picture(self, event=None):
-        if event:
-            event.widget.after_idle(self.open_picture_callback)
-        else:
-            self.open_picture_callback()
-
-    def open_picture_callback(self, e=None):
-        """
-        Show a file browser and set the new picture
-        """
-        # Limit the selection to png and jpg only
-        self.file_opened = filedialog.askopenfilename(
-            filetypes=(("PNG files", "*.png"),))
-        # If any files were opened, add them to files
-        if self.file_opened:
-            self.picture_var.set(self.file_opened)
-            self.update_picture()
-
-    def update_picture(self, event=None):
-        if event:
-            event.widget.after_idle(self.update_picture_callback)
-        else:
-            self.update_picture_callback()
-
-    def update_picture_callback(self, e=None):
-        """
-        Update the picture status label to match new the settings
-        """
-        if self.picture_enabled_var.get():
-            if self.picture_var.get():
-                self.picture_status_var.set(
-                    "All files will have this picture added")
-            else:
-                self.picture_status_var.set(
-                    "All files will have the picture removed")
-        else:
-            self.picture_status_var.set(
-                "All files will keep the current picture")
-
-    def update_fields(self):
-        """
-        Update the original values for each field
-        """
-        separator = ""
-        last_value = {}
-        all_the_same = {"version": True}
-        self.version_var.set("")
-        for field in ID3_FIELDS:
-            FIELDS[field].clear_original()
-            all_the_same[field] = True
-        remove_list = []
-        for file in FILES:
-            tag = ""
-            try:
-                tag = stagger.read_tag(file)
-            except FileNotFoundError:
-                Popup(
-                    self.frame,
-                    "Warning",
-                    "missing file: {}".format(file))
-                remove_list.append(file)
-            except stagger.errors.NoTagError:
-                Popup(
-                    self.frame,
-                    "Warning",
-                    "missing id3 tag: {}".format(file))
-                remove_list.append(file)
-            if tag:
-                for field in ID3_FIELDS:
-                    value = getattr(tag, field)
-                    FIELDS[field].set_original("{}{}{}".format(
-                        FIELDS[field].original(),
-                        separator,
-                        value))
-                    if field in last_value:
-                        if last_value[field] != value:
-                            all_the_same[field] = False
-                    last_value[field] = value
-                value = getattr(tag, "version")
-                self.version_var.set("{}{}{}".format(
-                    self.version_var.get(),
-                    separator,
-                    value))
-                if "version" in last_value:
-                    if last_value["version"] != value:
-                        all_the_same["version"] = False
-                last_value["version"] = value
-                separator = ";"
-        for file in remove_list:
-            FILES.remove(file)
-        if FILES:
-            for field in ID3_FIELDS:
-                if all_the_same[field]:
-                    FIELDS[field].set_original(last_value[field])
-                FIELDS[field].update_output()
-            if all_the_same["version"]:
-                self.version_var.set(last_value["version"])
+            journal.begin(spec)
+        except ValueError as error:
+            print(error, file=sys.stderr)
+            return 1
+    metrics = BatchMetrics() if args.metrics else None
+    if spec.numbering:
+        # The numbering needs the complete and ordered list of files
+        batch = TagBatch(
+            FileSet(selected),
+            spec,
+            args.workers,
+            executor,
+            reserve=args.reserve,
+            journal=journal,
+            metrics=metrics,
+            scheduler=scheduler,
+            records=records)
+        chunks = None
+    else:
+        batch = TagBatch(
+            [],
+            spec,
+            args.workers,
+            executor,
+            reserve=args.reserve,
+            journal=journal,
+            metrics=metrics,
+            scheduler=scheduler,
+            records=records)
+        chunks = chunked(selected, args.chunk_size)
+    if args.dry_run:
+        changed = write_report(batch.diffs(chunks), sys.stdout)
+        print("{} files would change or failed".format(changed),
+              file=sys.stderr)
+        print_duplicates(duplicates)
+        if metrics is not None:
+            write_metrics(metrics, args.metrics)
+        update_index(index, found)
+        return 0
+    results = batch.results(chunks)
+    total = 0
+    failed = 0
+    written = []
+    for file, error in results:
+        total += 1
+        if error:
+            failed += 1
+            print("{} - {}".format(file, error), file=sys.stderr)
+        elif index is not None:
+            written.append(file)
+    print("Processed {} of the {} files, {} needed a full rewrite, "
+          "{} were already up to date".format(
+              total - failed, total, batch.rewrites, batch.unchanged))
+    print_duplicates(duplicates)
+    if metrics is not None:
+        write_metrics(metrics, args.metrics)
+    update_index(index, found, written, records)
+    return 1 if failed else 0
+
+
+def print_duplicates(duplicates):
+    """
+    Print the files that were skipped by --dedup, and the file they match
+    """
+    for file, original in duplicates.items():
+        print("{} - duplicate of {}".format(file, original), file=sys.stderr)
+    if duplicates:
+        print("Skipped {} duplicate files".format(len(duplicates)),
+              file=sys.stderr)
 
 
-class Popup:
+def write_metrics(metrics, path):
     """
-    Popup class creates a toplevel with labels
-    It's not resizable, grabs the focus and stays on top
-    Optionally adds a link to it
+    Write the metrics as JSON if the path ends in .json,
+    otherwise in the Prometheus text format
     """
-    def __init__(self,
-                 frame,
-                 title,
-                 message,
-                 size=12,
-                 link_title=None,
-                 link=None,
-                 link_size=None):
-        popup = tk.Toplevel(frame, padx="40", pady="40")
-        # Add a link if provided
-        if link_title:
-            label = tk.Label(popup, text=message, font="-size {}".format(size))
-            label.grid(row=0)
-            link_label = tk.Label(
-                popup,
-                text=link_title,
-                fg="blue",
-                cursor="hand2",
-                font="-size {}".format(link_size))
-            link_label.bind(
-                "<Button-1>",
-                lambda e: webbrowser.open_new(link))
-            link_label.grid(row=1)
+    with open(path, "w", encoding="utf-8") as f:
+        if path.endswith(".json"):
+            json.dump(metrics.summary(), f, indent=2)
+            f.write("\n")
         else:
-            tk.Label(popup, text=message, font="-size {}".format(size)).pack()
-        popup.grab_set()
-        popup.title(title)
-        popup.resizable(False, False)
-        popup.wm_attributes("-topmost", True)
-        popup.bind("<Escape>", lambda e: popup.destroy())
+            f.write(metrics.prometheus())
 
 
-class Field(tk.Frame):
+def collect(files, found):
     """
-    Field class consists of a label, checkbox and three entry fields
-    A field will occupy a single row in the application
-    For every id3 field, a Field object will be created
-    (except for the picture and version)
+    Yield the files as they are found, and add each of them to the FileSet
     """
-    def __init__(self, name, row, master):
-        self.name = name
-        self.master = master
-        super(Field, self).__init__(master=master)
-        # label - title Label
-        self.label = tk.Label(self.master, text=self.title(name))
-        self.label.grid(column=0, row=row)
-        # original - old Entry
-        self.old_var = tk.StringVar()
-        self.old = tk.Entry(
-            self.master,
-            width=50,
-            state=tk.DISABLED,
-            textvariable=self.old_var)
-        self.old.grid(column=1, row=row)
-        # checkbox - enabled Checkbutton
-        self.checkbox_var = tk.IntVar()
-        self.checkbox = tk.Checkbutton(
-            self.master,
-            variable=self.checkbox_var)
-        self.checkbox.grid(column=2, row=row)
-        self.checkbox.bind("<Button-1>", self.update_output)
-        self.checkbox.bind("<Return>", self.update_output)
-        self.checkbox.bind("<space>", self.update_output)
-        # entry - input Entry
-        if name not in ["track", "track_total"]:
-            self.input_var = tk.StringVar()
-            self.input = tk.Entry(
-                self.master,
-                width=50,
-                textvariable=self.input_var)
-            self.input.grid(column=3, row=row)
-            self.input.bind("<Any-KeyPress>", self.update_output)
-        elif name == "track":
-            self.input = tk.Label(
-                self.master,
-                text="Automatically number the tracks")
-            self.input.grid(column=3, row=row)
-        elif name == "track_total":
-            self.input = tk.Label(
-                self.master,
-                text="Pad zeros to match the total number of tracks")
-            self.input.grid(column=3, row=row)
-        # output - new Entry
-        self.output_var = tk.StringVar()
-        self.output = tk.Entry(
-            self.master,
-            width=50,
-            state=tk.DISABLED,
-            textvariable=self.output_var)
-        self.output.grid(column=4, row=row)
+    for file in files:
+        found.add(file)
+        yield file
 
-    def title(self, text):
-        return text.title().replace("_", " ")
 
-    def set_original(self, text):
-        self.old_var.set(text)
-
-    def clear_original(self):
-        self.old_var.set("")
-
-    def original(self):
-        return self.old_var.get()
-
-    def checked(self):
-        return bool(self.checkbox_var.get())
-
-    def text(self):
-        return self.input_var.get()
-
-    def set_output(self, text):
-        self.output_var.set(text)
-
-    def update_output(self, event=None):
-        if event:
-            event.widget.after_idle(self.update_output_callback)
-        else:
-            self.update_output_callback()
-
-    def update_output_callback(self):
-        """
-        Update the output fields to match the new settings
-        """
-        if self.name in ["track", "track_total"]:
-            if FIELDS["track"].checked():
-                padding = FIELDS["track_total"].checked()
-                track, track_total = self.get_numbering(padding)
-                FIELDS["track"].set_output(track)
-                FIELDS["track_total"].set_output(track_total)
-            else:
-                FIELDS["track"].set_output(FIELDS["track"].original())
-                FIELDS["track_total"].set_output(
-                    FIELDS["track_total"].original())
-        else:
-            if not self.checked():
-                self.set_output(self.original())
-            else:
-                self.set_output(self.text())
-
-    def get_numbering(self, padding):
-        """
-        Returns a formatted string version of the numbering
-        """
-        if not FILES:
-            return "", ""
-        track = ""
-        track_total = str(len(FILES))
-        id = 1
-        for file in FILES:
-            if padding:
-                track += "{};".format(str(id).zfill(len(track_total)))
-            else:
-                track += "{};".format(id)
-            id += 1
-        track = track[:-1]
-        return track, track_total
+def update_index(index, files, written=(), records=None):
+    """
+    Update the index with the (new) tags of the files, if there is one
+    Errors are not printed again, failed files are removed from the index
+    The audio hashes of the written files are kept (see TagIndex),
+    and their tags are taken from the RecordCache instead of the files
+    """
+    if index is not None:
+        index.keep_hashes(written)
+        if records is not None:
+            index.store_records(records)
+        for _ in index.read_records(files):
+            pass
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    index = None
+    if args.index:
+        index = TagIndex(args.index)
+    try:
+        if args.find:
+            return find(args, index)
+        if not args.files:
+            # Tk is only imported for the gui,
+            # so the command line starts fast and works without a display
+            import gui
+            gui.start(__version__, index)
+            return 0
+        return run(args, index)
+    finally:
+        if index is not None:
+            index.close()
 
 
 if __name__ == "__main__":
-    # Create a root Tk object and start the application with it
-    root = tk.Tk()
-    root.protocol("WM_DELETE_WINDOW", lambda: close_window_callback(root))
-    root.resizable(False, False)
-    root.title("Py3ID3")
-    Application(root)
-    root.mainloop()
+    sys.exit(main())
@@ -0,0 +1,2521 @@
+"""
+Headless tag reading and writing for Py3ID3
+The Tk application is a thin client on top of this module,
+but it can be used on its own, without Tk or a display
+"""
+
+import collections
+import concurrent.futures
+import contextlib
+import copy
+import errno
+import functools
+import glob
+import hashlib
+import itertools
+import json
+import mmap
+import os
+import re
+import shutil
+import stagger
+import string
+import threading
+import time
+
+# The ID3 fields
+ID3_FIELDS = (
+    "title",
+    "artist",
+    "date",
+    "album_artist",
+    "album",
+    "track",
+    "track_total",
+    "disc",
+    "disc_total",
+    "composer",
+    "genre",
+    "comment",
+    "grouping")
+# Picture and version are special fields
+# They are implemented differently
+
+# Frames of the ID3 fields that are converted as they are (see convert_tag),
+# their id in version 3 and 4, the date and comment are set by value
+FIELD_FRAMES = (
+    "TIT2",
+    "TPE1",
+    "TPE2",
+    "TALB",
+    "TRCK",
+    "TPOS",
+    "TCOM",
+    "TCON",
+    "TIT1")
+# Frames of the date in all versions, which differ in every version
+DATE_FRAMES = ("TYE", "TDA", "TIM", "TYER", "TDAT", "TIME", "TDRC")
+# Fields that hold a number, and the order in which all fields are set,
+# the track total has to be set before the track
+NUMBER_FIELDS = ("track", "track_total", "disc", "disc_total")
+WRITE_ORDER = tuple(
+    field for field in ID3_FIELDS if field not in ("track", "track_total")
+) + ("track_total", "track")
+# Fields that often have the same value for many files,
+# a RecordCache stores each of their values only once
+SHARED_FIELDS = (
+    "artist",
+    "date",
+    "album_artist",
+    "album",
+    "composer",
+    "genre",
+    "grouping")
+# Names that can be used in a template besides the ID3 fields
+PATH_FIELDS = ("filename", "folder")
+
+# The versions that can be requested when writing
+# 0 means that the original version of each file is kept
+VERSIONS = (0, 2, 3, 4)
+
+# The kinds of worker pools that can be used to write a batch
+# Threads suit slow (network) storage, processes suit CPU bound encoding
+EXECUTORS = {
+    "thread": concurrent.futures.ThreadPoolExecutor,
+    "process": concurrent.futures.ProcessPoolExecutor}
+
+# Number of workers used by the gui, writing one file at a time is
+# mostly waiting for the disk, so a small pool of threads helps a lot
+DEFAULT_WORKERS = 4
+
+# Maximum number of values combined into a single original value,
+# the rest is summarized to keep huge selections responsive
+DISPLAY_LIMIT = 1000
+
+# Files accepted by scan_files, and the number of files per chunk
+MP3_EXTENSIONS = (".mp3",)
+DEFAULT_CHUNK_SIZE = 256
+
+# Ways to detect duplicate files (see unique_files), the same file
+# reached through different paths, or also files with the same audio
+DEDUP_MODES = ("file", "audio")
+# Bytes read at a time when hashing the audio of a file
+HASH_BLOCK_SIZE = 1024 * 1024
+
+# Bytes of padding added after a tag when the file has to be rewritten,
+# so that later edits can be written in place
+DEFAULT_RESERVE = 1024
+
+# Memory limit of a TagCache in bytes, pictures take up most of it
+DEFAULT_CACHE_SIZE = 256 * 1024 * 1024
+# Estimated memory used by a tag besides the binary frame data
+TAG_OVERHEAD = 2048
+
+# Memory that the copies of a picture may use in total in bytes,
+# worker processes each load the picture, so there are less of them if needed
+PICTURE_MEMORY = 256 * 1024 * 1024
+
+# Tags of at least this many bytes are memory mapped by a TagView
+MMAP_THRESHOLD = 64 * 1024
+
+# Phases of writing a file in order, each one is timed separately
+PHASES = ("read", "build", "picture", "write")
+# Counters of the batch metrics and their descriptions
+COUNTERS = {
+    "bytes_read": "Bytes parsed or copied from the files",
+    "bytes_written": "Bytes written to the files",
+    "rewrites": "Files that needed a full rewrite",
+    "unchanged": "Files that were skipped as the tag was the same"}
+# Short reasons of the errors and their messages, see FileError
+ERRORS = {
+    "missing_file": "missing file: {}",
+    "missing_tag": "missing id3 tag: {}",
+    "invalid_tag": "invalid id3 tag: {}",
+    "missing_picture": "missing picture: {}",
+    "invalid_field": "Invalid tag error: {}",
+    "invalid_picture": "Invalid picture error: {}",
+    "invalid_version": "Invalid version {}",
+    "write_error": "Write error: {}",
+    "restore_error": "Restore error: {}",
+    "pattern_mismatch": "pattern mismatch: {}",
+    "invalid_template": "Invalid template error: {}"}
+
+
+class EditSpec:
+    """
+    Plain data description of the changes for a batch of files
+    fields - dict of the enabled ID3 fields and their new text
+    numbering - automatically number the tracks
+    padding - pad zeros to match the total number of tracks
+    picture - None keeps the picture, "" removes it, a path replaces it
+    keep_obscure - keep obscure tags, converted if the ID3 version changes
+    version - the requested version, 2, 3, 4 or 0 for the original version
+    group - number per "folder" or per value of an ID3 field (see numbering)
+    discs - number the discs by folder within each group
+    pattern - path pattern that the field values are taken from
+    templates - dict of ID3 fields and their templates
+    """
+    def __init__(self,
+                 fields=None,
+                 numbering=False,
+                 padding=False,
+                 picture=None,
+                 keep_obscure=False,
+                 version=0,
+                 group=None,
+                 discs=False,
+                 pattern=None,
+                 templates=None):
+        self.fields = dict(fields or {})
+        self.numbering = numbering
+        self.padding = padding
+        self.picture = picture
+        self.keep_obscure = keep_obscure
+        self.version = version
+        self.group = group
+        self.discs = discs
+        self.pattern = pattern
+        self.templates = dict(templates or {})
+
+    def __repr__(self):
+        return "EditSpec({})".format(", ".join(
+            "{}={!r}".format(key, value)
+            for key, value in sorted(vars(self).items())))
+
+
+class FileSet:
+    """
+    Ordered set of files with constant time membership
+    The order is the order in which the files were added,
+    which is also the order of the automatic track numbering
+    """
+    def __init__(self, files=()):
+        self._files = []
+        self._positions = {}
+        self.extend(files)
+
+    def __len__(self):
+        return len(self._files)
+
+    def __iter__(self):
+        return iter(self._files)
+
+    def __contains__(self, file):
+        return file in self._positions
+
+    def __getitem__(self, position):
+        return self._files[position]
+
+    def __repr__(self):
+        return "FileSet({!r})".format(self._files)
+
+    def add(self, file):
+        """
+        Add a file to the end, unless it's already present
+        Returns True if the file was added
+        """
+        if file in self._positions:
+            return False
+        self._positions[file] = len(self._files)
+        self._files.append(file)
+        return True
+
+    def extend(self, files):
+        """
+        Add multiple files, duplicates are skipped
+        Returns the number of added files
+        """
+        added = 0
+        for file in files:
+            if self.add(file):
+                added += 1
+        return added
+
+    def remove(self, file):
+        self.remove_all([file])
+
+    def remove_all(self, files):
+        """
+        Remove multiple files at once, keeping the order of the others
+        The positions are only recalculated once for all files
+        """
+        remove = set(files) & self._positions.keys()
+        if not remove:
+            return
+        self._files = [file for file in self._files if file not in remove]
+        self._positions = {
+            file: position for position, file in enumerate(self._files)}
+
+    def clear(self):
+        self._files = []
+        self._positions = {}
+
+
+def is_mp3(file):
+    """
+    Check if a file starts with an ID3 tag or an mp3 frame header
+    """
+    try:
+        with open(file, "rb") as f:
+            header = f.read(3)
+    except OSError:
+        return False
+    if header.startswith(b"ID3"):
+        return True
+    return len(header) >= 2 and header[0] == 0xFF and header[1] & 0xE0 == 0xE0
+
+
+def scan_files(paths,
+               recursive=True,
+               extensions=MP3_EXTENSIONS,
+               magic=False,
+               inodes=None):
+    """
+    Lazily yield the mp3 files in a list of files, directories and globs
+    Directories are read with os.scandir one entry at a time,
+    so the first files are found before the scan is finished
+    extensions - tuple of lowercase extensions to accept, None for all
+    magic - only yield files that start like an mp3 (see is_mp3)
+    Paths that don't exist are yielded as is, if the extension matches
+    Linked directories are followed, but every directory is scanned once,
+    so a link to a parent folder doesn't yield the same files again
+    inodes - dict to which the inodes of the files in directories are added,
+    as scandir knows them without a stat (see IOScheduler)
+    """
+    yield from _scan_paths(
+        paths, recursive, extensions, magic, set(), inodes)
+
+
+def _scan_paths(paths, recursive, extensions, magic, visited, inodes):
+    # The visited directories are shared by the paths and the globs
+    for path in paths:
+        if os.path.isdir(path):
+            yield from _scan_directory(
+                path, recursive, extensions, magic, visited, inodes)
+        elif os.path.isfile(path):
+            if _accepted(path, extensions, magic):
+                yield path
+        elif glob.has_magic(path):
+            yield from _scan_paths(
+                glob.iglob(path, recursive=recursive),
+                recursive,
+                extensions,
+                magic,
+                visited,
+                inodes)
+        elif _accepted(path, extensions, False):
+            # Missing files are kept, so they are reported when reading
+            yield path
+
+
+def _scan_directory(directory, recursive, extensions, magic, visited, inodes):
+    # Only the entries of a single directory are kept at a time,
+    # they are sorted to get the same (numbering) order on every scan
+    try:
+        stat = os.stat(directory)
+        entries = os.scandir(directory)
+    except OSError:
+        return
+    if (stat.st_dev, stat.st_ino) in visited:
+        entries.close()
+        return
+    visited.add((stat.st_dev, stat.st_ino))
+    files = []
+    subdirectories = []
+    with entries:
+        for entry in entries:
+            try:
+                if entry.is_dir():
+                    if recursive:
+                        subdirectories.append(entry.path)
+                elif entry.is_file():
+                    files.append(entry)
+            except OSError:
+                pass
+    for entry in sorted(files, key=lambda entry: entry.path):
+        if _accepted(entry.path, extensions, magic):
+            if inodes is not None:
+                try:
+                    inodes[entry.path] = entry.inode()
+                except OSError:
+                    pass
+            yield entry.path
+    for subdirectory in sorted(subdirectories):
+        yield from _scan_directory(
+            subdirectory, recursive, extensions, magic, visited, inodes)
+
+
+def _accepted(file, extensions, magic):
+    if extensions and not file.lower().endswith(extensions):
+        return False
+    return not magic or is_mp3(file)
+
+
+def chunked(files, size=DEFAULT_CHUNK_SIZE):
+    """
+    Split an iterable of files into lists of at most size files
+    """
+    files = iter(files)
+    while True:
+        chunk = list(itertools.islice(files, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def file_identity(file):
+    """
+    Returns the device and inode of a file, which are the same for
+    hard links, symlinks and bind mounts of the same file
+    None is returned if the file system doesn't have inode numbers
+    """
+    stat = os.stat(file)
+    if not stat.st_ino:
+        return None
+    return stat.st_dev, stat.st_ino
+
+
+def audio_span(file):
+    """
+    Returns the position and size of the audio of a file,
+    which is everything between the ID3v2 tag and the ID3v1 tag (if any)
+    """
+    with open(file, "rb") as f:
+        header = f.read(10)
+        end = f.seek(0, os.SEEK_END)
+        start = 0
+        if len(header) == 10 and header.startswith(b"ID3"):
+            start = 10 + (
+                (header[6] & 0x7f) << 21 | (header[7] & 0x7f) << 14
+                | (header[8] & 0x7f) << 7 | header[9] & 0x7f)
+            if header[3] == 4 and header[5] & 0x10:
+                # Version 2.4 tags can have a footer of another 10 bytes
+                start += 10
+        if end - start >= 128:
+            f.seek(end - 128)
+            if f.read(3) == b"TAG":
+                end -= 128
+    start = min(start, end)
+    return start, end - start
+
+
+def audio_hash(file):
+    """
+    Returns the SHA-256 of the audio of a file as hex (see audio_span),
+    so files with different tags but the same audio have the same hash
+    The file is read in blocks, so the memory use doesn't depend on it
+    """
+    start, size = audio_span(file)
+    digest = hashlib.sha256()
+    with open(file, "rb") as f:
+        f.seek(start)
+        while size > 0:
+            block = f.read(min(size, HASH_BLOCK_SIZE))
+            if not block:
+                break
+            digest.update(block)
+            size -= len(block)
+    return digest.hexdigest()
+
+
+def unique_files(files, mode="file", hashes=None, duplicates=None):
+    """
+    Lazily yield the files that are not a duplicate of an earlier file
+    file - skip files that are the same as an earlier one (file_identity)
+    audio - also skip files with the same audio (audio_hash), the audio is
+    only hashed if an earlier file has the exact same audio size
+    The hashes are read from the TagIndex if given, so unchanged files
+    are not hashed again, and each skipped file is added to the
+    duplicates dict if given, with the earlier file it duplicates
+    Files that can't be read are yielded, so they are reported as usual
+    """
+    if mode not in DEDUP_MODES:
+        raise ValueError("Invalid dedup mode {}".format(mode))
+    if duplicates is None:
+        duplicates = {}
+    identities = {}
+    sizes = {}
+    digests = {}
+    for file in files:
+        try:
+            identity = file_identity(file)
+            if identity in identities:
+                duplicates[file] = identities[identity]
+                continue
+            if identity is not None:
+                identities[identity] = file
+            if mode == "audio":
+                original = _same_audio(file, sizes, digests, hashes)
+                if original is not None:
+                    duplicates[file] = original
+                    continue
+        except OSError:
+            pass
+        yield file
+
+
+def _same_audio(file, sizes, digests, hashes):
+    # Returns the earlier file with the same audio, if there is one
+    # The first file of each audio size is only hashed once another
+    # file with that size shows up, most sizes are only used once
+    hasher = audio_hash if hashes is None else hashes.audio_hash
+    _, size = audio_span(file)
+    if size not in sizes:
+        sizes[size] = file
+        return None
+    first = sizes[size]
+    if first is not None:
+        try:
+            digests.setdefault((size, hasher(first)), first)
+        except OSError:
+            pass
+        # The first file is hashed now, it's not needed anymore
+        sizes[size] = None
+    digest = hasher(file)
+    original = digests.setdefault((size, digest), file)
+    if original == file:
+        return None
+    return original
+
+
+def read_tag(file, handle=None):
+    """
+    Read the tag of a single file, from the open handle if given
+    Returns a tuple with the tag and the error message (if any)
+    """
+    try:
+        return stagger.read_tag(file if handle is None else handle), ""
+    except FileNotFoundError:
+        return None, FileError("missing_file", file)
+    except stagger.errors.NoTagError:
+        return None, FileError("missing_tag", file)
+    except stagger.errors.TagError:
+        return None, FileError("invalid_tag", file)
+
+
+def probe_tag(file):
+    """
+    Read only the text frames of a tag, which is enough for listing files
+    Other frames, such as pictures, are not copied at all (see TagView)
+    Unsynchronised tags are rare and are read completely instead
+    Returns a tuple with the tag and the error message (if any)
+    """
+    try:
+        with TagView(file) as view:
+            if view.tag.flags or not view.trusted:
+                return read_tag(file)
+            return view.text_tag(), ""
+    except FileNotFoundError:
+        return None, FileError("missing_file", file)
+    except stagger.errors.NoTagError:
+        return None, FileError("missing_tag", file)
+    except (stagger.errors.TagError, EOFError):
+        return None, FileError("invalid_tag", file)
+
+
+def is_text_frame(frameid):
+    """
+    Check if a frame is decoded by probe_tag, all others are binary
+    """
+    return frameid.startswith("T") or frameid in ("COM", "COMM")
+
+
+class TagView:
+    """
+    Zero copy view of the ID3v2 tag of a file, backed by mmap
+    Small tags are read at once instead, mapping them is slower than that
+    The frames are indexed by their position in the tag, without copying,
+    text frames are decoded on demand (see text_tag),
+    and the other frames are memoryviews that can be written as they are
+    Use it as a context manager, the views can't be used after closing it
+    An open handle of the file can be given, it's used but not closed
+    tag - empty stagger tag with the version, flags, offset and size
+    frames - list of the frame id, flags, start, data start and end
+    trusted - False if the frame sizes are invalid and can't be indexed
+    """
+    def __init__(self, file, handle=None):
+        self.file = file
+        self.frames = []
+        self.trusted = True
+        self._map = None
+        self._exported = []
+        self._owned = handle is None
+        self._file = open(file, "rb") if handle is None else handle
+        try:
+            tag_class = stagger.tags.detect_tag(self._file)[0]
+            self.tag = tag_class()
+            self.tag._read_header(self._file)
+            # The frames start after the header (and extended header)
+            start = self._file.tell()
+            end = self.tag.offset + self.tag.size
+            if end < MMAP_THRESHOLD:
+                self._file.seek(0)
+                self._map = self._file.read(end)
+            else:
+                self._map = mmap.mmap(
+                    self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.view = memoryview(self._map)
+            if not self.tag.flags:
+                self._index_frames(start)
+        except BaseException:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """
+        Release all views and close the file, it's safe to call it twice
+        """
+        if self._map is not None:
+            for view in self._exported:
+                view.release()
+            self._exported = []
+            self.view.release()
+            if isinstance(self._map, mmap.mmap):
+                self._map.close()
+            self._map = None
+        if self._owned:
+            self._file.close()
+
+    def _index_frames(self, position):
+        if self.tag.version == 2:
+            id_size, header_size = 3, 6
+        else:
+            id_size, header_size = 4, 10
+        end = min(self.tag.offset + self.tag.size, len(self.view))
+        while position + header_size <= end:
+            # Only the small frame headers are copied
+            header = self._map[position:position + header_size]
+            if not self.tag._is_frame_id(header[:id_size]):
+                break
+            size_bytes = header[id_size:id_size * 2]
+            if self.tag.version == 4:
+                # Some old versions of iTunes wrote invalid syncsafe sizes
+                if any(byte & 0x80 for byte in size_bytes):
+                    self.trusted = False
+                    return
+                size = 0
+                for byte in size_bytes:
+                    size = (size << 7) | byte
+            else:
+                size = int.from_bytes(size_bytes, "big")
+            data = position + header_size
+            if data + size > end:
+                raise EOFError
+            flags = None
+            if self.tag.version > 2:
+                flags = int.from_bytes(header[8:10], "big")
+            self.frames.append((
+                header[:id_size].decode("ASCII"),
+                flags,
+                position,
+                data,
+                data + size))
+            position = data + size
+
+    def text_tag(self):
+        """
+        Returns the tag with only the text frames decoded, like probe_tag
+        Only these small frames are copied out of the file
+        """
+        tag = self.tag
+        for number, (frameid, flags, _, data, end) in enumerate(self.frames):
+            if is_text_frame(frameid) and end > data:
+                frame = tag._decode_frame(
+                    frameid, flags, self._map[data:end], number)
+                if frame is not None:
+                    tag._frames.setdefault(frame.frameid, []).append(frame)
+        tag._filename = self.file
+        return tag
+
+    def binary_frames(self):
+        """
+        Returns a list of the ids and memoryviews of the complete frames
+        that are not text frames, empty frames are left out like stagger does
+        """
+        frames = [(frameid, self.view[start:end])
+                  for frameid, _, start, data, end in self.frames
+                  if not is_text_frame(frameid) and end > data]
+        self._exported.extend(view for _, view in frames)
+        return frames
+
+
+def tag_values(tag):
+    """
+    Returns a dict with the values of the ID3 fields and the version
+    """
+    values = {field: getattr(tag, field) for field in ID3_FIELDS}
+    values["version"] = tag.version
+    return values
+
+
+class TagRecord:
+    """
+    Compact record of the tag of a file, to keep many files loaded
+    It has the ID3 fields and the version as attributes, which can also
+    be looked up by name, like the dict of tag_values (see aggregate)
+    """
+    __slots__ = ("file", "mtime", "size", "version") + ID3_FIELDS
+
+    def __init__(self, file, stamp, values):
+        self.file = file
+        self.mtime, self.size = stamp
+        self.version = values["version"]
+        for field in ID3_FIELDS:
+            setattr(self, field, values[field])
+
+    def __getitem__(self, name):
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name)
+
+    def __repr__(self):
+        return "TagRecord({!r}, version={!r})".format(self.file, self.version)
+
+    @property
+    def stamp(self):
+        return self.mtime, self.size
+
+    def values(self):
+        """
+        Returns the same dict as tag_values does for the tag
+        """
+        values = {field: getattr(self, field) for field in ID3_FIELDS}
+        values["version"] = self.version
+        return values
+
+
+def read_record(file, stamp=None):
+    """
+    Read the TagRecord of a file, the tag itself is not kept (see probe_tag)
+    The stamp is read from the file if it's not given (see file_stamp)
+    Returns a tuple with the record and the error message (if any)
+    """
+    if stamp is None:
+        try:
+            stamp = file_stamp(file)
+        except FileNotFoundError:
+            return None, FileError("missing_file", file)
+    tag, error = probe_tag(file)
+    if error:
+        return None, error
+    return TagRecord(file, stamp, tag_values(tag)), ""
+
+
+class RecordCache:
+    """
+    Compact records of all files that were read (see TagRecord)
+    Files are only read again when their mtime or size changed
+    Unlike the TagCache there's no limit, 200k files fit in a few hundred MB,
+    also because repeated values, such as the album, are stored only once
+    """
+    def __init__(self):
+        self.records = {}
+        self.shared = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        with self.lock:
+            return iter(list(self.records.values()))
+
+    def read(self, file):
+        """
+        Returns a tuple with the record and the error message (if any)
+        """
+        try:
+            stamp = file_stamp(file)
+        except FileNotFoundError:
+            self.discard(file)
+            return None, FileError("missing_file", file)
+        with self.lock:
+            record = self.records.get(file)
+        if record is not None and record.stamp == stamp:
+            return record, ""
+        record, error = read_record(file, stamp)
+        if error:
+            self.discard(file)
+            return None, error
+        return self.store(record), ""
+
+    def store(self, record, replace=False):
+        """
+        Store a record, sharing its repeated values with the other records
+        Returns the stored record, or the one that was already stored
+        if the file didn't change since then, unless replace is True
+        The tag of a write always replaces it, as the mtime might not change
+        on file systems with a coarse mtime, and the size often stays the same
+        """
+        with self.lock:
+            stored = self.records.get(record.file)
+            if not replace and stored is not None and \
+                    stored.stamp == record.stamp:
+                return stored
+            for field in SHARED_FIELDS:
+                value = getattr(record, field)
+                setattr(record, field, self.shared.setdefault(value, value))
+            self.records[record.file] = record
+        return record
+
+    def discard(self, file):
+        with self.lock:
+            self.records.pop(file, None)
+
+    def clear(self):
+        with self.lock:
+            self.records = {}
+            self.shared = {}
+
+
+def read_records(files, records=None):
+    """
+    Read the TagRecord of all files in order, using the RecordCache if given
+    Yields a tuple with the file, the record and the error message (if any)
+    """
+    for file in files:
+        if records is None:
+            record, error = read_record(file)
+        else:
+            record, error = records.read(file)
+        yield file, record, error
+
+
+def aggregate(values_list, limit=DISPLAY_LIMIT):
+    """
+    Combine the values of multiple files into one string per field
+    A field with the same value for all files will show it only once,
+    otherwise the values are joined by ";", up to the limit
+    Returns a dict with the ID3 fields and the version
+    """
+    names = ID3_FIELDS + ("version",)
+    first = {}
+    all_the_same = {name: True for name in names}
+    shown = {name: [] for name in names}
+    count = 0
+    for values in values_list:
+        for name in names:
+            value = values[name]
+            if not count:
+                first[name] = value
+            elif all_the_same[name] and value != first[name]:
+                all_the_same[name] = False
+            if count < limit:
+                shown[name].append("{}".format(value))
+        count += 1
+    result = {}
+    for name in names:
+        if not count:
+            result[name] = ""
+        elif all_the_same[name]:
+            result[name] = "{}".format(first[name])
+        elif count > limit:
+            result[name] = "{};... ({} more)".format(
+                ";".join(shown[name]), count - limit)
+        else:
+            result[name] = ";".join(shown[name])
+    return result
+
+
+def numbering_preview(count, padding=False, limit=DISPLAY_LIMIT):
+    """
+    Returns the track and track total of the numbering of count files
+    The tracks are joined by ";" up to the limit, like aggregate does
+    """
+    if not count:
+        return "", ""
+    track_total = str(count)
+    width = len(track_total) if padding else 0
+    track = ";".join(
+        str(number).zfill(width) for number in range(1, min(count, limit) + 1))
+    if count > limit:
+        track += ";... ({} more)".format(count - limit)
+    return track, track_total
+
+
+def file_stamp(file):
+    """
+    Returns the modification time and size of a file
+    A tag is only reused from a cache while this stays the same
+    """
+    stat = os.stat(file)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def tag_size(tag, shared=None):
+    """
+    Returns an estimate of the memory used by a tag in bytes
+    Binary data in the shared dict (by id) is not counted,
+    as it's the same object for many tags (see CoverArt)
+    """
+    size = TAG_OVERHEAD
+    for frame in tag.values():
+        data = getattr(frame, "data", b"")
+        if not shared or id(data) not in shared:
+            size += len(data)
+    return size
+
+
+class TagCache:
+    """
+    In-memory cache of parsed tags, keyed by the path of the file
+    Entries are only used while the mtime and size of the file match,
+    the least recently used ones are dropped when max_size is exceeded
+    """
+    def __init__(self, max_size=DEFAULT_CACHE_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self.entries = collections.OrderedDict()
+        self.shared = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, file):
+        return file in self.entries
+
+    def read_tag(self, file, full=True):
+        """
+        Read the tag of a file, only parsing it if it's new or changed
+        Only the text frames are read if full is False (see probe_tag),
+        a full tag is read if only those are cached and full is True
+        Returns a tuple with the tag and the error message (if any)
+        """
+        return self.load(file, full)[:2]
+
+    def load(self, file, full=True, handle=None):
+        """
+        Same as read_tag, but also returns if the file was parsed,
+        False if the tag was taken from the cache
+        The open handle of the file is used for reading if given
+        """
+        try:
+            stamp = file_stamp(file)
+        except FileNotFoundError:
+            self.discard(file)
+            return None, FileError("missing_file", file), False
+        with self.lock:
+            entry = self.entries.get(file)
+            if entry and entry[0] == stamp and (entry[3] or not full):
+                self.entries.move_to_end(file)
+                return entry[1], "", False
+        if full:
+            tag, error = read_tag(file, handle)
+        else:
+            tag, error = probe_tag(file)
+        if error:
+            self.discard(file)
+        else:
+            self.store(file, tag, stamp, full)
+        return tag, error, True
+
+    def store(self, file, tag, stamp=None, full=True):
+        """
+        Store the tag of a file, for example right after writing it
+        The stamp is read from the file if it's not given,
+        full should be False for tags that were read with probe_tag
+        """
+        if stamp is None:
+            try:
+                stamp = file_stamp(file)
+            except OSError:
+                self.discard(file)
+                return
+        size = tag_size(tag, self.shared)
+        with self.lock:
+            self._remove(file)
+            self.entries[file] = (stamp, tag, size, full)
+            self.size += size
+            while self.size > self.max_size and len(self.entries) > 1:
+                self._remove(next(iter(self.entries)))
+
+    def share(self, data):
+        """
+        Count binary data only once, for example the picture of a batch
+        The data is counted right away and kept until the cache is cleared
+        """
+        if not data:
+            return
+        with self.lock:
+            if id(data) not in self.shared:
+                self.shared[id(data)] = data
+                self.size += len(data)
+
+    def discard(self, file):
+        """
+        Remove the tag of a file from the cache (if present)
+        """
+        with self.lock:
+            self._remove(file)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.shared.clear()
+            self.size = 0
+
+    def _remove(self, file):
+        entry = self.entries.pop(file, None)
+        if entry:
+            self.size -= entry[2]
+
+
+def write_tag(tag,
+              file,
+              reserve=DEFAULT_RESERVE,
+              journal=None,
+              raw_frames=(),
+              view=None,
+              handle=None):
+    """
+    Write a tag to a file, replacing the existing tag (if any)
+    If the new tag fits in the existing tag and its padding,
+    only that region is overwritten and the rest of the file is untouched
+    Otherwise the whole file is rewritten with reserve bytes of padding,
+    so later edits fit in place again
+    Both are crash safe: the new file is written next to the old one
+    and renamed over it, and in place writes are synced to disk,
+    with a backup of the old tag in the journal (see BatchJournal)
+    If the rename would lose hard links, the owner or extended attributes,
+    the new file is copied over the old one in place instead (see can_replace),
+    which can be finished by the journal if it's interrupted
+    The raw frames are added to the tag as they are (see encode_tag),
+    the TagView they come from is closed before the file is replaced
+    An open handle of the file (rb+) is used instead of opening it again,
+    it's closed when done, as the file can't be replaced while it's open
+    Returns a tuple with True if the whole file had to be rewritten,
+    the number of bytes copied from the old file and the bytes written
+    """
+    if handle is None:
+        handle = open(file, "rb+")
+    with handle as f:
+        try:
+            offset, length = stagger.tags.detect_tag(f)[1:3]
+        except stagger.errors.NoTagError:
+            offset, length = 0, 0
+        chunks = encode_tag(tag, length, reserve, raw_frames)
+        size = sum(len(chunk) for chunk in chunks)
+        in_place = size == length
+        if in_place and journal is not None:
+            journal.start(file, f, offset, length, in_place)
+        if in_place:
+            # Raw frames may move within the region that's overwritten,
+            # so they are copied before writing anything
+            data = b"".join(chunks)
+            if view is not None:
+                view.close()
+            f.seek(offset)
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+            return False, 0, size
+        temp = copy_path(file)
+        if journal is not None:
+            # Recorded before it's created, so it's removed after a crash
+            journal.start(file, f, offset, length, in_place, temp)
+        write_copy(f, file, temp, offset, length, chunks)
+        copied = f.tell() - length
+        replace = can_replace(f, temp)
+        if not replace and journal is not None:
+            journal.start(file, f, offset, length, in_place, temp, copy=True)
+        if not replace:
+            if view is not None:
+                view.close()
+            copy_over(temp, f)
+            # The new file is written twice, once to the copy
+            return True, copied, 2 * (copied + size)
+    if view is not None:
+        view.close()
+    replace_file(temp, file)
+    return True, copied, copied + size
+
+
+def encode_tag(tag, length, reserve=DEFAULT_RESERVE, raw_frames=()):
+    """
+    Encode a tag to replace an old tag of length bytes
+    It's padded to exactly that length if it fits, otherwise with reserve
+    Raw frames are complete frames of the same ID3 version,
+    for example memoryviews of a TagView, which are added after the frames
+    of the tag without decoding or copying them
+    Returns a list of chunks that make up the new tag
+    """
+    if not raw_frames:
+        # Any amount of padding is fine, as long as the size stays the same
+        tag.padding_max = None
+        tag.padding_default = 0
+        data = tag.encode(size_hint=length)
+        if len(data) != length and data:
+            tag.padding_max = reserve
+            tag.padding_default = reserve
+            data = tag.encode()
+        return [data]
+    tag.padding_max = None
+    tag.padding_default = 0
+    # The header is replaced, to include the raw frames in the size
+    frames = tag.encode()[10:]
+    size = 10 + len(frames) + sum(len(frame) for frame in raw_frames)
+    total = length if size <= length else size + reserve
+    header = b"ID3" + bytes((tag.version, 0, 0)) + \
+        stagger.conversion.Syncsafe.encode(total - 10, width=4)
+    return [header, frames] + list(raw_frames) + [bytes(total - size)]
+
+
+def copy_path(file):
+    """
+    Returns a new path for a copy of the file (see write_copy),
+    a hidden file in the same folder with a random name
+    """
+    return os.path.join(
+        os.path.dirname(os.path.realpath(file)),
+        ".{}.py3id3".format(os.urandom(8).hex()))
+
+
+def write_copy(f, file, temp, offset, length, chunks):
+    """
+    Write a copy of the open file with the chunks instead of the old tag
+    The copy is created at the path of copy_path and synced to disk,
+    it's removed again if writing it fails
+    """
+    # Binary mode is only a flag on Windows
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0)
+    handle = os.open(temp, flags, 0o600)
+    try:
+        with os.fdopen(handle, "wb") as copy_file:
+            f.seek(0)
+            copy_file.write(f.read(offset))
+            for chunk in chunks:
+                copy_file.write(chunk)
+            f.seek(offset + length)
+            shutil.copyfileobj(f, copy_file)
+            copy_file.flush()
+            os.fsync(copy_file.fileno())
+        shutil.copymode(file, temp)
+    except BaseException:
+        os.remove(temp)
+        raise
+
+
+def can_replace(f, temp):
+    """
+    Give the temp file the owner, group and extended attributes
+    of the open file, so it can be renamed over it (see replace_file)
+    Returns False if that's not possible or if the file has other hard links,
+    which would keep the old file after the rename
+    """
+    stat = os.fstat(f.fileno())
+    if stat.st_nlink > 1:
+        return False
+    try:
+        if hasattr(os, "chown"):
+            temp_stat = os.stat(temp)
+            if (temp_stat.st_uid, temp_stat.st_gid) != (
+                    stat.st_uid, stat.st_gid):
+                os.chown(temp, stat.st_uid, stat.st_gid)
+        if hasattr(os, "listxattr"):
+            try:
+                names = os.listxattr(f.fileno())
+            except OSError as error:
+                if error.errno not in (errno.ENOTSUP, errno.EOPNOTSUPP):
+                    raise
+                names = []
+            for name in names:
+                os.setxattr(temp, name, os.getxattr(f.fileno(), name))
+    except OSError:
+        return False
+    return True
+
+
+def copy_over(temp, f):
+    """
+    Copy the temp file over the open file in place, and remove it
+    The file keeps its inode, so hard links and attributes stay the same
+    """
+    with open(temp, "rb") as copy_file:
+        f.seek(0)
+        shutil.copyfileobj(copy_file, f)
+        f.truncate()
+        f.flush()
+        os.fsync(f.fileno())
+    os.remove(temp)
+
+
+def replace_file(temp, file):
+    """
+    Rename the temp file over the file, links are followed
+    A crash leaves either the old or the new file, but never a mix of both
+    """
+    target = os.path.realpath(file)
+    try:
+        os.replace(temp, target)
+    except BaseException:
+        os.remove(temp)
+        raise
+    # The rename itself is only durable once the folder is synced
+    sync_folder(target)
+
+
+def sync_folder(file):
+    """
+    Sync the folder of a file, so a new or renamed file is on disk
+    Only possible on systems that can open folders, such as Linux
+    """
+    if hasattr(os, "O_DIRECTORY"):
+        folder = os.open(os.path.dirname(file) or ".", os.O_RDONLY)
+        try:
+            os.fsync(folder)
+        finally:
+            os.close(folder)
+
+
+class BatchJournal:
+    """
+    Write-ahead journal of a batch, stored as JSON Lines
+    The first line has the EditSpec of the batch, a journal of another
+    batch is restored and started over (see begin)
+    Every file is recorded as writing before its tag is written,
+    and as done, unchanged or failed afterwards
+    For in place writes the old tag bytes are kept as a backup,
+    in a file next to the journal that's removed once the file is finished,
+    full rewrites don't need one, as the old file is replaced atomically,
+    or the complete copy is copied over it again (see write_tag)
+    When a journal of an interrupted batch is opened again,
+    the files that were finished are skipped (see TagBatch),
+    and files that were interrupted are restored by recover
+    Lines are appended with a single write, so processes can share it
+    """
+    def __init__(self, path):
+        self.path = path
+        self.spec = None
+        self.finished = set()
+        self.interrupted = {}
+        self._handle = None
+        # Backups of the files that are being written by this process
+        self._backups = {}
+        self.load()
+
+    def __getstate__(self):
+        # Every worker process opens the journal itself
+        state = self.__dict__.copy()
+        state["_handle"] = None
+        return state
+
+    def load(self):
+        """
+        Read the status of each file from an existing journal
+        A partly written last line of a crashed batch is ignored
+        """
+        if not os.path.isfile(self.path):
+            return
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record["status"] == "batch":
+                    self.spec = record["spec"]
+                    continue
+                file = record["file"]
+                if record["status"] == "writing":
+                    self.interrupted[file] = record
+                    continue
+                self.interrupted.pop(file, None)
+                if record["status"] in ("done", "unchanged"):
+                    self.finished.add(file)
+
+    def begin(self, spec):
+        """
+        Start the batch of the EditSpec, or resume it if it's the same
+        A journal of another batch is restored first and then emptied,
+        ValueError is raised if some of its files couldn't be restored
+        """
+        key = json.dumps(vars(spec), sort_keys=True)
+        if self.spec == key:
+            return
+        if self.spec is not None or self.finished or self.interrupted:
+            self.recover()
+            if self.interrupted:
+                raise ValueError(
+                    "Journal {} is of another batch and {} files couldn't be "
+                    "restored".format(self.path, len(self.interrupted)))
+        self.close()
+        with open(self.path, "w", encoding="utf-8"):
+            pass
+        self.spec = key
+        self.finished = set()
+        self.record({"status": "batch", "spec": key}, sync=True)
+
+    def backup_path(self, file):
+        """
+        Returns the path of the backup of the old tag of a file
+        """
+        name = hashlib.sha256(file.encode("utf-8", "surrogateescape"))
+        return "{}.{}.backup".format(self.path, name.hexdigest()[:32])
+
+    def record(self, record, sync=False):
+        """
+        Append a record to the journal, synced to disk if requested
+        """
+        if self._handle is None:
+            self._handle = os.open(
+                self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        os.write(self._handle, line.encode("utf-8"))
+        if sync:
+            os.fsync(self._handle)
+
+    def start(self, file, f, offset, length, in_place, temp=None, copy=False):
+        """
+        Record that a file is about to be written, called by write_tag
+        The temp file of a rewrite is recorded before it's written,
+        and again with copy if the synced temp file will be copied over
+        the file, instead of renamed (see can_replace)
+        The record and the backup are synced, so they are on disk before
+        the file changes
+        """
+        record = {"file": file, "status": "writing"}
+        if in_place:
+            f.seek(offset)
+            backup = self.backup_path(file)
+            with open(backup, "wb") as backup_file:
+                backup_file.write(f.read(length))
+                backup_file.flush()
+                os.fsync(backup_file.fileno())
+            sync_folder(backup)
+            self._backups[file] = backup
+            record["offset"] = offset
+            record["size"] = os.fstat(f.fileno()).st_size
+            record["backup_file"] = backup
+        elif copy:
+            record["copy"] = temp
+        else:
+            record["temp"] = temp
+        self.record(record, sync=True)
+
+    def finish(self, result):
+        """
+        Record the FileResult of a file
+        """
+        record = {"file": result.file, "status": "done"}
+        if result.error:
+            record["status"] = "failed"
+            record["error"] = result.error
+        elif result.unchanged:
+            record["status"] = "unchanged"
+        self.record(record)
+        backup = self._backups.pop(result.file, None)
+        if backup is not None:
+            os.remove(backup)
+
+    def recover(self):
+        """
+        Restore the old tag of files that were interrupted while writing
+        Only files that were written in place and still have the same size
+        are restored, rewritten files are already either old or new
+        Files that were being copied over are finished with the copy instead,
+        as long as it's there, it's only removed once the file is complete
+        The temp file of other rewrites is removed if it's still there,
+        the file itself is then still the old one
+        Files that fail to restore are kept in interrupted
+        """
+        for file, record in list(self.interrupted.items()):
+            if "copy" in record and os.path.isfile(record["copy"]):
+                try:
+                    with open(file, "rb+") as f:
+                        copy_over(record["copy"], f)
+                except OSError:
+                    continue
+            if "temp" in record and os.path.isfile(record["temp"]):
+                try:
+                    os.remove(record["temp"])
+                except OSError:
+                    continue
+            if "backup_file" in record:
+                try:
+                    with open(record["backup_file"], "rb") as f:
+                        backup = f.read()
+                    with open(file, "rb+") as f:
+                        if os.fstat(f.fileno()).st_size == record["size"]:
+                            f.seek(record["offset"])
+                            f.write(backup)
+                            f.flush()
+                            os.fsync(f.fileno())
+                except OSError:
+                    continue
+            del self.interrupted[file]
+            self.record({"file": file, "status": "restored"}, sync=True)
+            if "backup_file" in record:
+                os.remove(record["backup_file"])
+
+    def close(self, remove=False):
+        """
+        Close the journal, and remove it if the batch was completed
+        """
+        if self._handle is not None:
+            os.close(self._handle)
+            self._handle = None
+        if remove and os.path.isfile(self.path):
+            os.remove(self.path)
+
+
+class PathPattern:
+    """
+    Pattern that takes field values from the path of a file,
+    for example "{artist}/{album}/{track} - {title}"
+    It matches the end of the path without the extension,
+    "/" separates the folders and {_} matches a part that's ignored
+    The pattern is compiled to a regular expression once
+    """
+    def __init__(self, pattern):
+        self.pattern = pattern
+        regex = ""
+        for text, name, spec, conversion in string.Formatter().parse(
+                pattern):
+            regex += re.escape(text)
+            if name is None:
+                continue
+            if spec or conversion:
+                raise ValueError("Invalid pattern {}".format(pattern))
+            if name == "_":
+                regex += "[^/]*?"
+            elif name in NUMBER_FIELDS:
+                regex += "(?P<{}>\\d+)".format(name)
+            elif name in ID3_FIELDS:
+                regex += "(?P<{}>[^/]+?)".format(name)
+            else:
+                raise ValueError("Invalid field {}".format(name))
+        try:
+            self.regex = re.compile("(?:^|/){}$".format(regex))
+        except re.error:
+            raise ValueError("Invalid pattern {}".format(pattern))
+
+    def __getstate__(self):
+        # Worker processes compile the pattern again
+        return self.pattern
+
+    def __setstate__(self, pattern):
+        self.__init__(pattern)
+
+    def match(self, file):
+        """
+        Returns a dict of the values in the path, or None if it's different
+        """
+        path = os.path.splitext(file)[0].replace(os.sep, "/")
+        match = self.regex.search(path)
+        if match is None:
+            return None
+        return match.groupdict()
+
+
+class FieldTemplate:
+    """
+    Template for the value of a field, for example "{artist} - {title}"
+    Any ID3 field can be used, and the filename and folder of the file
+    The names are checked once, when the template is created
+    """
+    def __init__(self, template):
+        self.template = template
+        try:
+            parts = list(string.Formatter().parse(template))
+        except ValueError:
+            raise ValueError("Invalid template {}".format(template))
+        for _, name, _, _ in parts:
+            if name is not None and name not in ID3_FIELDS + PATH_FIELDS:
+                raise ValueError("Invalid field {}".format(name))
+
+    def format(self, values):
+        return self.template.format_map(values)
+
+
+def path_names(file):
+    """
+    Returns the filename (without extension) and folder name of a file
+    """
+    folder, filename = os.path.split(file)
+    return {
+        "filename": os.path.splitext(filename)[0],
+        "folder": os.path.basename(folder)}
+
+
+def number_files(files,
+                 padding=False,
+                 group=None,
+                 discs=False,
+                 records=None,
+                 pattern=None):
+    """
+    Number the tracks of all files in a single pass, in the order of files
+    Without a group all files are numbered as a single album,
+    otherwise per "folder" or per value of an ID3 field, such as "album",
+    which is taken from the PathPattern if it has it,
+    otherwise from the records of the files (see read_records)
+    With discs every folder within a group is a separate disc
+    Returns a dict with the numbering fields for each file
+    """
+    if group is None:
+        keys = ((file, None) for file in files)
+    elif group == "folder":
+        keys = ((file, os.path.dirname(file)) for file in files)
+    elif pattern and group in pattern.regex.groupindex:
+        keys = ((file, (pattern.match(file) or {}).get(group))
+                for file in files)
+    elif group in ID3_FIELDS:
+        keys = ((file, record[group] if record else None)
+                for file, record, _ in read_records(files, records))
+    else:
+        raise ValueError("Invalid group {}".format(group))
+    groups = {}
+    for file, key in keys:
+        folder = os.path.dirname(file) if discs else None
+        groups.setdefault(key, {}).setdefault(folder, []).append(file)
+    numbers = {}
+    for folders in groups.values():
+        for disc, tracks in enumerate(folders.values(), 1):
+            track_total = len(tracks)
+            width = len(str(track_total)) if padding else 0
+            for track, file in enumerate(tracks, 1):
+                numbers[file] = {
+                    "track": str(track).zfill(width),
+                    "track_total": track_total}
+                if discs:
+                    numbers[file]["disc"] = disc
+                    numbers[file]["disc_total"] = len(folders)
+    return numbers
+
+
+def picture_frameid(version):
+    """
+    Returns the id of the picture frame for an ID3 version
+    """
+    return "PIC" if version == 2 else "APIC"
+
+
+class CoverArt:
+    """
+    Picture that's shared by all files of a batch
+    The image is read once, and the frame for each ID3 version is built
+    once from that data, after which the same frame is reused every time
+    Only the path is pickled, so a worker process loads it once as well
+    """
+    def __init__(self, path):
+        self.path = path
+        self._frames = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+
+    def frame(self, version):
+        """
+        Returns the PIC (version 2) or APIC (version 3 and 4) frame
+        Raises an OSError if the image can't be read
+        """
+        key = 2 if version == 2 else 3
+        with self._lock:
+            if key not in self._frames:
+                if self._frames:
+                    # Convert the loaded frame, instead of reading it again
+                    loaded = next(iter(self._frames.values()))
+                    self._frames[key] = loaded._to_version(version)
+                else:
+                    frame_class = stagger.tags.Tag.known_frames[
+                        picture_frameid(version)]
+                    self._frames[key] = frame_class(value=self.path)
+            return self._frames[key]
+
+    @property
+    def data(self):
+        """
+        The image data, shared by all frames (None if not loaded yet)
+        """
+        for frame in self._frames.values():
+            return frame.data
+        return None
+
+    @property
+    def nbytes(self):
+        """
+        Memory used by the image data, which is only stored once
+        """
+        data = self.data
+        return len(data) if data else 0
+
+
+def copy_tag(tag):
+    """
+    Returns a copy of a tag that can be changed without changing the tag
+    The frame lists are copied, the frames are shared until replaced
+    """
+    new_tag = copy.copy(tag)
+    new_tag.flags = set(tag.flags)
+    new_tag._frames = {
+        frameid: list(frames) for frameid, frames in tag._frames.items()}
+    return new_tag
+
+
+def frame_signature(frame):
+    """
+    Returns the id and the values of a frame, except for the text encoding,
+    which is chosen again by stagger when writing the frame
+    """
+    return (frame.frameid, tuple(
+        getattr(frame, spec.name, None)
+        for spec in frame._framespec
+        if spec.name != "encoding"))
+
+
+def tags_equal(old_tag, new_tag):
+    """
+    Check if writing the new tag would store the same frames as the old tag
+    """
+    if old_tag.version != new_tag.version:
+        return False
+    if old_tag._frames.keys() != new_tag._frames.keys():
+        return False
+    for frameid, frames in old_tag._frames.items():
+        new_frames = new_tag._frames[frameid]
+        if len(frames) != len(new_frames):
+            return False
+        for frame, new_frame in zip(frames, new_frames):
+            if frame is not new_frame and \
+                    frame_signature(frame) != frame_signature(new_frame):
+                return False
+    return True
+
+
+def dropped_frames(old_tag, new_tag):
+    """
+    Returns the sorted ids of the frames of the old tag that have
+    no counterpart in the new tag, after converting them to its version
+    """
+    dropped = set()
+    for frameid in old_tag:
+        try:
+            converted = old_tag.frames(frameid)[0]._to_version(
+                new_tag.version).frameid
+        except (ValueError, TypeError, stagger.errors.FrameError):
+            converted = None
+        if converted not in new_tag:
+            dropped.add(frameid)
+    return sorted(dropped)
+
+
+@functools.lru_cache(maxsize=None)
+def frame_table(version):
+    """
+    Returns a dict with the frame class of the ID3 version for every frame
+    class known to stagger, or None if the frame has no counterpart,
+    for example TT2 and TIT2 both become TIT2 for version 3
+    The table follows stagger's own conversions (see Frame._to_version),
+    except for the frames of the date, which are converted by value
+    """
+    table = {}
+    for frame_class in stagger.tags.Tag.known_frames.values():
+        target = None
+        if frame_class._in_version(version):
+            target = frame_class
+        elif version == 2 and hasattr(frame_class, "_v2_frame"):
+            target = frame_class._v2_frame
+        elif frame_class._in_version(2):
+            base = frame_class.__bases__[0]
+            if issubclass(base, stagger.frames.Frame) and \
+                    base._in_version(version):
+                target = base
+        if frame_class.frameid in DATE_FRAMES:
+            target = None
+        table[frame_class] = target
+    return table
+
+
+def convert_tag(old_tag, version, keep_obscure=False):
+    """
+    Returns a new tag of the ID3 version with the frames of the old tag,
+    converted in a single pass with the frame_table of the version
+    Frames that are already in the right version are shared, not copied
+    Only the frames of the ID3 fields are converted, unless obscure frames
+    should be kept, and those without a counterpart are always dropped
+    Pictures and the date are left out, they are converted separately
+    """
+    new_tag = {
+        2: stagger.tags.Tag22,
+        3: stagger.tags.Tag23,
+        4: stagger.tags.Tag24}[version]()
+    table = frame_table(version)
+    # The ids of the field frames are looked up in version 3
+    field_table = frame_table(3)
+    for frameid, frames in old_tag._frames.items():
+        if frameid in ("PIC", "APIC"):
+            continue
+        converted = []
+        for frame in frames:
+            target = table.get(type(frame))
+            if target is None:
+                continue
+            if not keep_obscure:
+                field_class = field_table.get(type(frame))
+                if field_class is None or \
+                        field_class.frameid not in FIELD_FRAMES:
+                    continue
+            # The frames of version 2 are subclasses of the others
+            if type(frame) is not target:
+                frame = target._from_frame(frame)
+            converted.append(frame)
+        if converted:
+            new_tag._frames.setdefault(
+                converted[0].frameid, []).extend(converted)
+    return new_tag
+
+
+def copy_pictures(old_tag, new_tag):
+    """
+    Copy the picture frames of the old tag to the new tag in memory
+    Frames are only converted if the versions differ (PIC and APIC),
+    otherwise the same frames are passed through untouched
+    stagger raises a TypeError for a PIC frame in an unknown format
+    """
+    frames = []
+    for frameid in ("PIC", "APIC"):
+        if frameid in old_tag:
+            for frame in old_tag[frameid]:
+                frames.append(frame._to_version(new_tag.version))
+        if frameid in new_tag:
+            del new_tag[frameid]
+    if frames:
+        new_tag[picture_frameid(new_tag.version)] = frames
+
+
+class FileError(str):
+    """
+    Error message of a file, built from the reason and the detail
+    reason - short name of the error, for example "write_error" (see ERRORS)
+    detail - the path, or the message of the exception that caused it
+    It's a regular string otherwise, so it's returned like other messages
+    """
+    def __new__(cls, reason, detail):
+        detail = str(detail)
+        error = super().__new__(cls, ERRORS[reason].format(detail))
+        error.reason = reason
+        error.detail = detail
+        return error
+
+    def __getnewargs__(self):
+        return self.reason, self.detail
+
+
+class FileResult:
+    """
+    Result of writing a single file
+    error - the error message (if any), a FileError with the reason
+    rewritten - True if the whole file was rewritten, not just the tag
+    unchanged - True if the write was skipped, as the tag was the same
+    timings - the seconds spent in each phase (see PhaseTimer)
+    bytes_read - bytes parsed or copied from the file
+    bytes_written - bytes written to the file
+    record - TagRecord of the written tag, if the batch keeps records
+    """
+    def __init__(self,
+                 file,
+                 error="",
+                 rewritten=False,
+                 unchanged=False,
+                 timings=None):
+        self.file = file
+        self.error = error
+        self.rewritten = rewritten
+        self.unchanged = unchanged
+        self.timings = {} if timings is None else timings
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.record = None
+
+    @property
+    def reason(self):
+        """
+        Short name of the error, for example "missing_file" (see ERRORS)
+        """
+        if not self.error:
+            return ""
+        return getattr(self.error, "reason", "other")
+
+    @property
+    def detail(self):
+        """
+        The path or the message of the exception of the error (see FileError)
+        """
+        return getattr(self.error, "detail", self.error)
+
+    def __repr__(self):
+        return "FileResult({!r}, {!r}, {!r}, {!r})".format(
+            self.file, self.error, self.rewritten, self.unchanged)
+
+
+class PhaseTimer:
+    """
+    Measures the seconds spent in each phase of writing a file
+    Every lap is counted for the given phase, since the previous lap
+    """
+    def __init__(self):
+        self.timings = {}
+        self.start = time.perf_counter()
+
+    def lap(self, phase):
+        now = time.perf_counter()
+        self.timings[phase] = self.timings.get(phase, 0) + now - self.start
+        self.start = now
+
+
+class BatchMetrics:
+    """
+    Timings and counters of the files written by a TagBatch
+    The results are added in the main process, also for worker processes,
+    and every hook is called with each FileResult right after that
+    Export them with summary (a dict) or prometheus (the text format)
+    """
+    def __init__(self, hooks=()):
+        self.hooks = list(hooks)
+        self.files = 0
+        self.seconds = {phase: 0 for phase in PHASES}
+        self.counts = {phase: 0 for phase in PHASES}
+        self.counters = {counter: 0 for counter in COUNTERS}
+        self.failures = collections.Counter()
+
+    def add(self, result):
+        """
+        Add the timings and counts of a FileResult and call the hooks
+        """
+        self.files += 1
+        for phase, seconds in result.timings.items():
+            self.seconds[phase] = self.seconds.get(phase, 0) + seconds
+            self.counts[phase] = self.counts.get(phase, 0) + 1
+        self.counters["bytes_read"] += result.bytes_read
+        self.counters["bytes_written"] += result.bytes_written
+        self.counters["rewrites"] += result.rewritten
+        self.counters["unchanged"] += result.unchanged
+        if result.error:
+            self.failures[result.reason] += 1
+        for hook in self.hooks:
+            hook(result)
+
+    def summary(self):
+        """
+        Returns a dict with all metrics, which can be dumped as JSON
+        """
+        return {
+            "files": self.files,
+            "phases": {phase: {
+                "seconds": round(self.seconds[phase], 6),
+                "files": self.counts[phase]} for phase in self.seconds},
+            "counters": dict(self.counters),
+            "failures": dict(self.failures)}
+
+    def prometheus(self):
+        """
+        Returns the metrics in the Prometheus text format,
+        for example for the textfile collector of the node exporter
+        """
+        lines = [
+            "# HELP py3id3_files_total Files processed by the batch",
+            "# TYPE py3id3_files_total counter",
+            "py3id3_files_total {}".format(self.files),
+            "# HELP py3id3_phase_seconds_total Seconds spent in each phase",
+            "# TYPE py3id3_phase_seconds_total counter"]
+        for phase, seconds in self.seconds.items():
+            lines.append('py3id3_phase_seconds_total{{phase="{}"}} {}'.format(
+                phase, repr(float(seconds))))
+        lines += [
+            "# HELP py3id3_phase_files_total Files that reached each phase",
+            "# TYPE py3id3_phase_files_total counter"]
+        for phase, count in self.counts.items():
+            lines.append('py3id3_phase_files_total{{phase="{}"}} {}'.format(
+                phase, count))
+        for counter, value in self.counters.items():
+            lines += [
+                "# HELP py3id3_{}_total {}".format(
+                    counter, COUNTERS[counter]),
+                "# TYPE py3id3_{}_total counter".format(counter),
+                "py3id3_{}_total {}".format(counter, value)]
+        lines += [
+            "# HELP py3id3_failures_total Failed files by reason",
+            "# TYPE py3id3_failures_total counter"]
+        for reason, count in sorted(self.failures.items()):
+            lines.append('py3id3_failures_total{{reason="{}"}} {}'.format(
+                reason, count))
+        return "\n".join(lines) + "\n"
+
+
+class IOScheduler:
+    """
+    Limits the I/O of a batch, to keep (network) storage responsive
+    Files are handled in the order of their folder and inode,
+    so each folder is visited once and its files are read in disk order,
+    the inodes are taken from scan_files, files without one are sorted by name
+    max_open - maximum number of files that are open at the same time
+    bytes_per_second - average bytes read and written per second
+    Either limit can be None, worker processes share them with per_process
+    """
+    def __init__(self, max_open=None, bytes_per_second=None):
+        if max_open is not None and max_open < 1:
+            raise ValueError("Invalid max open files {}".format(max_open))
+        if bytes_per_second is not None and bytes_per_second <= 0:
+            raise ValueError("Invalid bytes per second {}".format(
+                bytes_per_second))
+        self.max_open = max_open
+        self.bytes_per_second = bytes_per_second
+        self._slots = None
+        if max_open is not None:
+            self._slots = threading.BoundedSemaphore(max_open)
+        # Inodes of the scanned files, removed once they're ordered
+        self.inodes = {}
+        # Moment from which the next file can be started
+        self._ready = 0
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        return {
+            "max_open": self.max_open,
+            "bytes_per_second": self.bytes_per_second}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def per_process(self, workers):
+        """
+        Returns the scheduler of each worker process, with the limits divided
+        over the workers, so together they stay within the limits
+        There can't be more workers than files that can be open at once
+        """
+        max_open = self.max_open
+        if max_open is not None:
+            max_open = max(1, max_open // workers)
+        bytes_per_second = self.bytes_per_second
+        if bytes_per_second is not None:
+            bytes_per_second /= workers
+        return IOScheduler(max_open, bytes_per_second)
+
+    def order(self, files):
+        """
+        Returns a list of the files sorted by their folder and inode,
+        the files are not accessed, the inodes are those of scan_files
+        """
+        def key(file):
+            return os.path.dirname(file), self.inodes.pop(file, 0), file
+        return sorted(files, key=key)
+
+    @contextlib.contextmanager
+    def slot(self):
+        """
+        Wait until another file can be opened and the rate allows it,
+        the file should be closed at the end of the with block
+        """
+        if self._slots is None:
+            self.wait()
+            yield
+            return
+        with self._slots:
+            self.wait()
+            yield
+
+    def wait(self):
+        """
+        Sleep until the bytes of the earlier files are within the rate
+        """
+        with self._lock:
+            delay = self._ready - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def transferred(self, size):
+        """
+        Count the bytes read and written for a file, which delays the next
+        """
+        if not self.bytes_per_second:
+            return
+        with self._lock:
+            self._ready = max(self._ready, time.monotonic()) + (
+                size / self.bytes_per_second)
+
+
+def open_file(file):
+    """
+    Open a file for reading and writing its tag, so it's only opened once
+    Returns None if that's not possible, it's then opened for each phase,
+    so the error is reported the same way as before (missing or read only)
+    """
+    try:
+        return open(file, "rb+")
+    except OSError:
+        return None
+
+
+class TagBatch:
+    """
+    TagBatch applies an EditSpec to a list of files
+    It doesn't depend on Tk, so it can run on a headless machine
+    Files are written by a pool of workers if more than one is requested,
+    the executor is either "thread" or "process" (see EXECUTORS),
+    there are less processes if their pictures exceed PICTURE_MEMORY
+    An optional TagCache is used for reading and filled after writing,
+    worker processes don't share it, there it only saves the first read
+    An optional RecordCache is filled with the written tags by results,
+    also for worker processes, so the written files aren't read again
+    Tags are written in place when possible, see write_tag for the reserve,
+    the number of files that needed a full rewrite is kept in rewrites
+    Files with a tag that's already the same are not written at all,
+    the number of these is kept in unchanged
+    With a BatchJournal an interrupted batch can be resumed,
+    files that were finished before are counted as unchanged
+    With BatchMetrics the phases of writing each file are timed
+    With an IOScheduler the files are ordered and the I/O is limited,
+    the results are then in the order of the scheduler
+    """
+    def __init__(self,
+                 files,
+                 spec,
+                 workers=1,
+                 executor="thread",
+                 cache=None,
+                 reserve=DEFAULT_RESERVE,
+                 journal=None,
+                 metrics=None,
+                 scheduler=None,
+                 records=None):
+        if executor not in EXECUTORS:
+            raise ValueError("Invalid executor {}".format(executor))
+        if reserve < 0:
+            raise ValueError("Invalid reserve {}".format(reserve))
+        if not isinstance(files, FileSet):
+            files = FileSet(files)
+        self.files = files
+        self.spec = spec
+        self.workers = max(1, workers)
+        self.executor = executor
+        self.cache = cache
+        self.cover = CoverArt(spec.picture) if spec.picture else None
+        self.reserve = reserve
+        self.journal = journal
+        self.metrics = metrics
+        self.scheduler = scheduler
+        self.records = records
+        # The records are sent back with the results by the workers
+        self.keep_records = records is not None
+        # Templates are compiled once, the numbering is done in one pass
+        self.pattern = PathPattern(spec.pattern) if spec.pattern else None
+        self.templates = {
+            field: FieldTemplate(template)
+            for field, template in spec.templates.items()}
+        self.numbers = None
+        self.rewrites = 0
+        self.unchanged = 0
+        self.cancelled = threading.Event()
+
+    def __getstate__(self):
+        # The cache stays in the main process when using worker processes
+        state = self.__dict__.copy()
+        state["cache"] = None
+        state["records"] = None
+        state["cancelled"] = None
+        state["metrics"] = None
+        return state
+
+    def picture_memory(self):
+        """
+        Returns the memory used by the shared picture in bytes
+        Threads share a single copy, every worker process has its own
+        """
+        if not self.cover:
+            return 0
+        if not self.cover.nbytes:
+            try:
+                self.cover.frame(self.spec.version or 3)
+            except (OSError, ValueError):
+                return 0
+        if self.executor == "process" and self.workers > 1:
+            return self.cover.nbytes * self.workers
+        return self.cover.nbytes
+
+    def write(self):
+        """
+        Read the tags and write them to each file
+        Returns a dict of the failed files and their error messages
+        """
+        skipped = {}
+        for file, error in self.results():
+            if error:
+                skipped[file] = error
+        return skipped
+
+    def results(self, chunks=None):
+        """
+        Write every file, using the worker pool if there is one
+        Files are taken from the chunks instead if given (see chunked)
+        Yields a tuple with the file and the error message (if any),
+        in the same order as the files (unless there's an IOScheduler)
+        Interrupted files of the journal are restored first,
+        and the journal is removed once all files are processed
+        """
+        if chunks is None:
+            chunks = [self.files]
+        elif self.spec.numbering:
+            raise ValueError("Automatic numbering needs all files upfront")
+        self.prepare()
+        if self.journal is not None:
+            self.journal.begin(self.spec)
+            self.journal.recover()
+        for result in self._results(chunks):
+            if self.records is not None:
+                if result.record is not None:
+                    self.records.store(result.record, replace=True)
+                elif result.error:
+                    self.records.discard(result.file)
+            if result.rewritten:
+                self.rewrites += 1
+            if result.unchanged:
+                self.unchanged += 1
+            if self.metrics is not None:
+                self.metrics.add(result)
+            yield result.file, result.error
+        if self.journal is not None:
+            # Kept for a resume, or for files that still need a restore
+            self.journal.close(remove=not (
+                self.cancelled.is_set() or self.journal.interrupted))
+
+    def _results(self, chunks, method="write_file"):
+        # Call a method of the batch for every file, in the worker pool
+        # Files that haven't started yet are skipped after cancel is called
+        if self.scheduler is not None:
+            chunks = (self.scheduler.order(chunk) for chunk in chunks)
+        if self.workers == 1:
+            for chunk in chunks:
+                for file in chunk:
+                    if self.cancelled.is_set():
+                        return
+                    yield getattr(self, method)(file)
+            return
+        workers = self.workers
+        if self.executor == "process":
+            # Less processes if their copies of the picture are too large
+            if self.picture_memory() > PICTURE_MEMORY:
+                workers = max(1, PICTURE_MEMORY // self.cover.nbytes)
+            # Every process has a scheduler, the limits are divided over them
+            scheduler = None
+            if self.scheduler is not None:
+                if self.scheduler.max_open is not None:
+                    workers = min(workers, self.scheduler.max_open)
+                scheduler = self.scheduler.per_process(workers)
+            # The batch is sent to each process once, instead of per file
+            pool = EXECUTORS["process"](
+                max_workers=workers,
+                initializer=_init_worker,
+                initargs=(self, scheduler))
+            worker = functools.partial(_worker, method)
+        else:
+            pool = EXECUTORS["thread"](max_workers=self.workers)
+            worker = getattr(self, method)
+        try:
+            for chunk in chunks:
+                chunk = list(chunk)
+                chunksize = 1
+                if self.executor == "process":
+                    chunksize = max(1, len(chunk) // (workers * 4))
+                for result in pool.map(worker, chunk, chunksize=chunksize):
+                    if self.cancelled.is_set():
+                        return
+                    yield result
+        finally:
+            pool.shutdown(cancel_futures=True)
+
+    def cancel(self):
+        """
+        Stop the batch, files that are being written will be finished
+        It's safe to call this from another thread than the one running it
+        """
+        self.cancelled.set()
+
+    def diffs(self, chunks=None):
+        """
+        Dry run of the batch, the new tags are built but not written
+        Files are taken from the chunks instead if given (see chunked)
+        Yields a dict for every file that would change or fails to read,
+        files that would stay the same are skipped (see diff_file)
+        With BatchMetrics the reading and building of the tags is timed,
+        and files that would stay the same are counted as unchanged
+        """
+        if chunks is None:
+            chunks = [self.files]
+        elif self.spec.numbering:
+            raise ValueError("Automatic numbering needs all files upfront")
+        self.prepare()
+        for diff, result in self._results(chunks, "_diff_file"):
+            if self.metrics is not None:
+                self.metrics.add(result)
+            if diff:
+                yield diff
+
+    def diff_file(self, file):
+        """
+        Build the new tag of a single file without writing it
+        Returns a dict with the file and the error message, or the changes:
+        a list of the old and new value for each changed field,
+        and the ids of the frames that won't be kept (the obscure ones)
+        Returns None if the tag would stay the same (see tags_equal)
+        """
+        return self._diff_file(file)[0]
+
+    def _diff_file(self, file):
+        # Returns the diff and a FileResult for the metrics of a dry run
+        timer = PhaseTimer()
+        slot = contextlib.nullcontext()
+        if self.scheduler is not None:
+            slot = self.scheduler.slot()
+        with slot:
+            if self.cache is None:
+                old_tag, error = read_tag(file)
+            else:
+                old_tag, error = self.cache.read_tag(file)
+        timer.lap("read")
+        if self.scheduler is not None and not error:
+            self.scheduler.transferred(old_tag.size)
+        if not error:
+            version = self.file_version(old_tag.version)
+            new_tag, error = self.build_tag(old_tag, file, version)
+            timer.lap("build")
+        result = FileResult(file, error, timings=timer.timings)
+        if error:
+            return {"file": file, "error": error}, result
+        result.bytes_read = old_tag.size
+        if tags_equal(old_tag, new_tag):
+            result.unchanged = True
+            return None, result
+        old_values = tag_values(old_tag)
+        new_values = tag_values(new_tag)
+        old_values["picture"] = old_tag.picture
+        new_values["picture"] = new_tag.picture
+        changes = {}
+        for name, value in new_values.items():
+            if old_values[name] != value:
+                changes[name] = [old_values[name], value]
+        dropped = dropped_frames(old_tag, new_tag)
+        diff = {"file": file, "changes": changes}
+        if dropped:
+            diff["dropped"] = dropped
+        return diff, result
+
+    def write_file(self, file):
+        """
+        Read the tag of a single file and write the new one
+        Returns a FileResult
+        """
+        if self.journal is None:
+            return self._write_file(file)
+        if file in self.journal.finished:
+            return FileResult(file, unchanged=True)
+        if file in self.journal.interrupted:
+            # The old tag couldn't be restored, so it's left alone
+            return FileResult(file, FileError("restore_error", file))
+        result = self._write_file(file)
+        self.journal.finish(result)
+        return result
+
+    def _write_file(self, file):
+        if self.scheduler is None:
+            return self._write_handle(file, open_file(file))
+        with self.scheduler.slot():
+            result = self._write_handle(file, open_file(file))
+        self.scheduler.transferred(result.bytes_read + result.bytes_written)
+        return result
+
+    def _write_handle(self, file, handle):
+        # The file is read and written with the same handle (if any)
+        try:
+            return self._write_tag_file(file, handle)
+        finally:
+            if handle is not None:
+                handle.close()
+
+    def _write_tag_file(self, file, handle):
+        timer = PhaseTimer()
+        try:
+            view = TagView(file, handle)
+        except (OSError, EOFError, stagger.errors.Error):
+            # The error is reported by the regular read below
+            view = None
+        if view is not None:
+            with view:
+                kept = self.kept_frames(view)
+                if kept is not None:
+                    tag = view.text_tag()
+                    timer.lap("read")
+                    version = self.file_version(tag.version)
+                    result = self.write_tag_to_file(
+                        tag, file, version, timer, view, *kept,
+                        handle=handle)
+                    result.bytes_read += tag.size
+                    return result
+        if self.cache is None:
+            tag, error = read_tag(file, handle)
+            parsed = True
+        else:
+            tag, error, parsed = self.cache.load(file, handle=handle)
+        timer.lap("read")
+        if error:
+            return FileResult(file, error, timings=timer.timings)
+        version = self.file_version(tag.version)
+        result = self.write_tag_to_file(
+            tag, file, version, timer, handle=handle)
+        if parsed:
+            result.bytes_read += tag.size
+        return result
+
+    def kept_frames(self, view):
+        """
+        Returns the binary frames of a TagView that are kept as they are,
+        and True if any are dropped, or None if that's not possible
+        If the version stays the same, only the text frames are decoded,
+        the pictures and obscure frames are copied as bytes, the obscure
+        ones only if they are kept by convert_tag as well (or for version 0)
+        A new picture is compared to the old one, so that needs a full read
+        """
+        if view.tag.flags or not view.trusted or self.cover:
+            return None
+        version = self.file_version(view.tag.version)
+        if version not in (0, view.tag.version):
+            return None
+        table = frame_table(view.tag.version)
+        kept = []
+        dropped = False
+        for frameid, frame in view.binary_frames():
+            if frameid in ("PIC", "APIC"):
+                keep = self.spec.picture is None
+            elif version == 0:
+                keep = True
+            else:
+                frame_class = stagger.tags.Tag.known_frames.get(frameid)
+                keep = self.spec.keep_obscure and \
+                    table.get(frame_class) is not None
+            if keep:
+                kept.append(frame)
+            else:
+                dropped = True
+        return kept, dropped
+
+    def file_version(self, tag_version):
+        """
+        Calculates the required version for the new tag
+        """
+        requested_version = self.spec.version
+        # If the versions match and the obscure tags should be kept, return 0
+        if tag_version == requested_version:
+            if self.spec.keep_obscure:
+                return 0
+        # If the requested version is not set, keep the original version
+        if requested_version == 0:
+            return tag_version
+        # Else set the version to the requested version
+        return requested_version
+
+    def prepare(self):
+        """
+        Number all files in a single pass if the spec asks for it,
+        this is done before the workers start, so it only happens once
+        """
+        if self.spec.numbering and self.numbers is None:
+            self.numbers = number_files(
+                self.files,
+                self.spec.padding,
+                self.spec.group,
+                self.spec.discs,
+                pattern=self.pattern)
+
+    def numbering(self, file):
+        """
+        Returns a dict with the track and track total for a file,
+        and the disc and disc total if the discs are numbered
+        """
+        self.prepare()
+        try:
+            return self.numbers[file]
+        except KeyError:
+            raise ValueError("{} is not in the file set".format(file))
+
+    def new_values(self, old_values, file):
+        """
+        Returns the new value of every ID3 field for a file,
+        and the error message (if any)
+        The old values are replaced by the values from the path pattern,
+        the fields of the spec, the numbering and lastly the templates
+        """
+        values = dict(old_values)
+        if self.pattern:
+            path_values = self.pattern.match(file)
+            if path_values is None:
+                return None, FileError("pattern_mismatch", file)
+            values.update(path_values)
+        values.update(self.spec.fields)
+        if self.spec.numbering:
+            values.update(self.numbering(file))
+        if self.templates:
+            names = dict(values, **path_names(file))
+            for field, template in self.templates.items():
+                try:
+                    values[field] = template.format(names)
+                except (ValueError, KeyError, IndexError) as error:
+                    return None, FileError("invalid_template", error)
+        return values, ""
+
+    def build_tag(self, old_tag, file, version, timer=None):
+        """
+        Create the new tag for a file based on the old tag and the spec
+        The build and picture phases are timed if a PhaseTimer is given
+        Returns a tuple with the new tag and the error message (if any)
+        """
+        if version not in VERSIONS:
+            return None, FileError("invalid_version", version)
+        old_values = {field: getattr(old_tag, field) for field in ID3_FIELDS}
+        values, error = self.new_values(old_values, file)
+        if error:
+            return None, error
+        if version == 0:
+            # The old tag is kept as is, it might be cached or compared
+            new_tag = copy_tag(old_tag)
+            fields = WRITE_ORDER
+        else:
+            # Convert the frames, so only the changed fields are set,
+            # besides the date and comment, which are set by value
+            try:
+                new_tag = convert_tag(
+                    old_tag, version, self.spec.keep_obscure)
+            except (ValueError, TypeError, stagger.errors.FrameError) as error:
+                return None, FileError("invalid_field", error)
+            fields = [field for field in WRITE_ORDER
+                      if field in ("date", "comment")
+                      or values[field] != old_values[field]]
+        # Set the fields
+        for field in fields:
+            try:
+                setattr(new_tag, field, values[field])
+            except (ValueError, KeyError) as error:
+                return None, FileError("invalid_field", error)
+        if timer is not None:
+            timer.lap("build")
+        # Picture
+        if self.cover:
+            try:
+                new_tag[picture_frameid(new_tag.version)] = [
+                    self.cover.frame(new_tag.version)]
+            except OSError:
+                return None, FileError("missing_picture", self.spec.picture)
+            except ValueError as error:
+                return None, FileError("invalid_picture", error)
+        elif self.spec.picture is not None:
+            new_tag.picture = ""
+        else:
+            try:
+                copy_pictures(old_tag, new_tag)
+            except (ValueError, TypeError, stagger.errors.FrameError) as error:
+                return None, FileError("invalid_picture", error)
+        if timer is not None:
+            timer.lap("picture")
+        return new_tag, ""
+
+    def write_tag_to_file(self,
+                          old_tag,
+                          file,
+                          version,
+                          timer=None,
+                          view=None,
+                          raw_frames=(),
+                          dropped=False,
+                          handle=None):
+        """
+        Write the fields to the file as part of a tag
+        The old tag only has the text frames if it's from a TagView,
+        the raw frames of the view are then kept (see kept_frames)
+        The open handle is used for writing if given (see write_tag)
+        Returns a FileResult, with the timings of the PhaseTimer
+        """
+        if timer is None:
+            timer = PhaseTimer()
+        new_tag, error = self.build_tag(old_tag, file, version, timer)
+        if error:
+            return FileResult(file, error, timings=timer.timings)
+        if not dropped and tags_equal(old_tag, new_tag):
+            return FileResult(file, unchanged=True, timings=timer.timings)
+        # Write to file
+        try:
+            rewritten, copied, written = write_tag(
+                new_tag,
+                file,
+                self.reserve,
+                self.journal,
+                raw_frames,
+                view,
+                handle)
+        except OSError as error:
+            if self.cache is not None:
+                self.cache.discard(file)
+            timer.lap("write")
+            return FileResult(
+                file, FileError("write_error", error), timings=timer.timings)
+        # Keep the tag that was just written, instead of reading it again
+        if self.cache is not None or self.keep_records:
+            stamp = file_stamp(file)
+        if self.cache is not None:
+            if self.cover:
+                self.cache.share(self.cover.data)
+            # The raw frames are not part of the new tag object
+            self.cache.store(file, new_tag, stamp, full=not raw_frames)
+        timer.lap("write")
+        result = FileResult(file, rewritten=rewritten, timings=timer.timings)
+        result.bytes_read = copied
+        result.bytes_written = written
+        if self.keep_records:
+            # Stored by results, so it also works for worker processes
+            result.record = TagRecord(file, stamp, tag_values(new_tag))
+        return result
+
+
+# The batch of the current worker process, set once by _init_worker
+_WORKER_BATCH = None
+
+
+def _init_worker(batch, scheduler=None):
+    """
+    Store the batch in a worker process, so it's only pickled once
+    The scheduler replaces the one of the batch, with the limits per process
+    """
+    global _WORKER_BATCH
+    batch.scheduler = scheduler
+    _WORKER_BATCH = batch
+
+
+def _worker(method, file):
+    """
+    Call a method of the batch for a single file in a worker process
+    """
+    return getattr(_WORKER_BATCH, method)(file)
+
+
+def write_report(diffs, stream):
+    """
+    Write the diffs of a dry run to a stream as JSON Lines
+    Every line is flushed right away, so the report can be followed live
+    Returns the number of written lines
+    """
+    count = 0
+    for diff in diffs:
+        stream.write(json.dumps(diff, ensure_ascii=False))
+        stream.write("\n")
+        stream.flush()
+        count += 1
+    return count
@@ -0,0 +1,247 @@
+"""
+Optional on-disk index of the tags of a music library for Py3ID3
+The path, mtime, size, version and ID3 fields of each file are stored
+in a local SQLite file, so opening a folder again doesn't need to parse
+the files that didn't change, and queries don't parse any file at all
+The audio hashes used to find duplicates are stored there as well
+"""
+
+import sqlite3
+import threading
+
+from tagbatch import (
+    ID3_FIELDS,
+    FileError,
+    TagRecord,
+    audio_hash,
+    file_stamp,
+    read_record)
+
+# Version of the table layout, the index is rebuilt if it doesn't match
+SCHEMA_VERSION = 1
+# Number of paths that are looked up in a single query
+LOOKUP_SIZE = 500
+# Columns of the files table after the path
+COLUMNS = ("mtime", "size", "version") + ID3_FIELDS
+# Columns that are stored as numbers, so "3" finds track 3
+NUMBERS = ("mtime", "size", "version", "track", "track_total", "disc",
+           "disc_total")
+
+
+class TagIndex:
+    """
+    SQLite index of the tags of files, updated incrementally
+    A file is only read again if its mtime or size changed
+    """
+    def __init__(self, path):
+        self.path = path
+        # Reading happens in the background thread of the gui
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        # New audio hashes, stored together to avoid a commit per file
+        self.new_hashes = []
+        self.create_tables()
+
+    def create_tables(self):
+        with self.lock, self.connection:
+            version = self.connection.execute(
+                "PRAGMA user_version").fetchone()[0]
+            if version != SCHEMA_VERSION:
+                self.connection.execute("DROP TABLE IF EXISTS files")
+                self.connection.execute("DROP TABLE IF EXISTS hashes")
+            columns = ", ".join(
+                "{} {}".format(column, "INTEGER" if column in NUMBERS
+                               else "TEXT") for column in COLUMNS)
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS files "
+                "(path TEXT PRIMARY KEY, {})".format(columns))
+            for field in ("artist", "album_artist", "album"):
+                self.connection.execute(
+                    "CREATE INDEX IF NOT EXISTS files_{0} "
+                    "ON files ({0})".format(field))
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS hashes (path TEXT PRIMARY KEY, "
+                "mtime INTEGER, size INTEGER, digest TEXT)")
+            self.connection.execute(
+                "PRAGMA user_version = {}".format(SCHEMA_VERSION))
+
+    def close(self):
+        self.store_hashes()
+        self.connection.close()
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute(
+                "SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def read_records(self, files, records=None):
+        """
+        Read the records of the files, from the index if they didn't change
+        New and changed files are read with read_record (or the RecordCache),
+        and are stored in the index right away
+        Yields a tuple with the file, the TagRecord and the error (if any),
+        the picture of records from the index is not known
+        """
+        files = iter(files)
+        while True:
+            chunk = []
+            for file in files:
+                chunk.append(file)
+                if len(chunk) == LOOKUP_SIZE:
+                    break
+            if not chunk:
+                return
+            yield from self._read_chunk(chunk, records)
+
+    def _read_chunk(self, files, records):
+        rows = self.lookup(files)
+        updates = []
+        removes = []
+        for file in files:
+            try:
+                stamp = file_stamp(file)
+            except FileNotFoundError:
+                removes.append(file)
+                yield file, None, FileError("missing_file", file)
+                continue
+            row = rows.get(file)
+            if row and (row["mtime"], row["size"]) == stamp:
+                record = TagRecord(file, stamp, row)
+                if records is not None:
+                    record = records.store(record)
+                yield file, record, ""
+                continue
+            if records is None:
+                record, error = read_record(file, stamp)
+            else:
+                record, error = records.read(file)
+            if error:
+                removes.append(file)
+                yield file, None, error
+                continue
+            updates.append((file, record.stamp, record.values()))
+            yield file, record, ""
+        self.store(updates)
+        self.remove(removes)
+
+    def lookup(self, files):
+        """
+        Returns a dict of the rows of the files that are in the index
+        """
+        files = list(files)
+        rows = {}
+        with self.lock:
+            for start in range(0, len(files), LOOKUP_SIZE):
+                part = files[start:start + LOOKUP_SIZE]
+                cursor = self.connection.execute(
+                    "SELECT path, {} FROM files WHERE path IN ({})".format(
+                        ", ".join(COLUMNS),
+                        ", ".join("?" * len(part))),
+                    part)
+                for row in cursor:
+                    rows[row[0]] = dict(zip(COLUMNS, row[1:]))
+        return rows
+
+    def store(self, updates):
+        """
+        Store a list of tuples with the file, the stamp and the values
+        The stamp is the mtime and size of the file (see file_stamp)
+        """
+        if not updates:
+            return
+        rows = []
+        for file, stamp, values in updates:
+            rows.append((file, stamp[0], stamp[1], values["version"]) + tuple(
+                values[field] for field in ID3_FIELDS))
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO files (path, {}) "
+                "VALUES ({})".format(
+                    ", ".join(COLUMNS),
+                    ", ".join("?" * (len(COLUMNS) + 1))),
+                rows)
+
+    def store_records(self, records):
+        """
+        Store the TagRecords of files, for example those of a RecordCache
+        that a TagBatch filled with the tags it wrote
+        """
+        self.store([
+            (record.file, record.stamp, record.values())
+            for record in records])
+
+    def remove(self, files):
+        """
+        Remove files from the index, for example after they were deleted
+        """
+        if not files:
+            return
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "DELETE FROM files WHERE path = ?",
+                [(file,) for file in files])
+
+    def audio_hash(self, file):
+        """
+        Returns the audio_hash of a file, from the index if it didn't change
+        New hashes are stored per LOOKUP_SIZE files and when closing
+        """
+        stamp = file_stamp(file)
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT mtime, size, digest FROM hashes WHERE path = ?",
+                (file,)).fetchone()
+        if row and (row[0], row[1]) == stamp:
+            return row[2]
+        digest = audio_hash(file)
+        with self.lock:
+            self.new_hashes.append((file, stamp[0], stamp[1], digest))
+            full = len(self.new_hashes) >= LOOKUP_SIZE
+        if full:
+            self.store_hashes()
+        return digest
+
+    def store_hashes(self):
+        """
+        Store the new audio hashes (see audio_hash)
+        """
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO hashes (path, mtime, size, digest) "
+                "VALUES (?, ?, ?, ?)",
+                self.new_hashes)
+            self.new_hashes = []
+
+    def keep_hashes(self, files):
+        """
+        Keep the audio hashes of files after only their tag was written,
+        as that doesn't change the audio, only the mtime and size
+        """
+        self.store_hashes()
+        updates = []
+        for file in files:
+            try:
+                updates.append(file_stamp(file) + (file,))
+            except FileNotFoundError:
+                pass
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "UPDATE hashes SET mtime = ?, size = ? WHERE path = ?",
+                updates)
+
+    def find(self, **fields):
+        """
+        Returns the sorted paths of the files with all of the given values,
+        for example find(album="X"), without reading any of the files
+        """
+        for field in fields:
+            if field not in COLUMNS:
+                raise ValueError("Invalid field {}".format(field))
+        query = "SELECT path FROM files"
+        if fields:
+            query += " WHERE " + " AND ".join(
+                "{} = ?".format(field) for field in fields)
+        query += " ORDER BY path"
+        with self.lock:
+            return [row[0] for row in self.connection.execute(
+                query, list(fields.values()))]
@@ -0,0 +1,388 @@
+#!/usr/bin/env python3
+"""
+Regression checks of the batch engine, run with `python -m unittest`
+The mp3 files are generated in a temp folder for every test
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import stagger
+
+from benchmark import FRAME_HEADER, SIZES, write_mp3
+from tagbatch import (
+    BatchJournal,
+    BatchMetrics,
+    EditSpec,
+    IOScheduler,
+    PathPattern,
+    RecordCache,
+    TagBatch,
+    number_files,
+    read_tag,
+    scan_files,
+    unique_files,
+    write_tag)
+
+TAG_CLASSES = {
+    2: stagger.tags.Tag22,
+    3: stagger.tags.Tag23,
+    4: stagger.tags.Tag24}
+
+
+def make_file(folder, name, frames, version=3, **values):
+    """
+    Write an mp3 file with a tag of the version with the frames and values
+    Returns the path of the file
+    """
+    tag = TAG_CLASSES[version]()
+    tag.title = "Title"
+    for field, value in values.items():
+        setattr(tag, field, value)
+    for frame in frames:
+        tag[frame.frameid] = frame
+    file = os.path.join(folder, name)
+    write_mp3(file, tag)
+    return file
+
+
+def tag_length(file):
+    """
+    Returns the length of the tag of a file, including its padding
+    """
+    with open(file, "rb") as f:
+        return stagger.tags.detect_tag(f)[2]
+
+
+class TestWritePaths(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+
+    def test_obscure_frames_match(self):
+        # The TagView path and the build_tag path keep the same frames
+        for keep_obscure in (False, True):
+            file = make_file(self.folder, "view.mp3", [
+                stagger.id3.TENC(text=["Encoder"]),
+                stagger.id3.PRIV(owner="owner", data=b"private"),
+                stagger.id3.APIC(
+                    mime="image/png", type=3, desc="", data=b"\x89PNG")])
+            copy = os.path.join(self.folder, "build.mp3")
+            shutil.copy(file, copy)
+            spec = EditSpec(
+                fields={"title": "New {}".format(keep_obscure)},
+                keep_obscure=keep_obscure)
+            batch = TagBatch([file, copy], spec)
+            diffs = list(batch.diffs())
+            self.assertFalse(batch.write_file(file).error)
+            tag, _ = read_tag(copy)
+            result = batch.write_tag_to_file(
+                tag, copy, batch.file_version(tag.version))
+            self.assertFalse(result.error)
+            view_frames = sorted(read_tag(file)[0]._frames)
+            build_frames = sorted(read_tag(copy)[0]._frames)
+            self.assertEqual(view_frames, build_frames)
+            self.assertEqual(keep_obscure, "PRIV" in view_frames)
+            self.assertEqual(
+                keep_obscure, "dropped" not in diffs[0], diffs[0])
+
+    @unittest.skipUnless(hasattr(os, "link"), "needs hard links")
+    def test_rewrite_keeps_hard_links(self):
+        # A full rewrite can't rename a copy over a file with hard links
+        file = make_file(self.folder, "file.mp3", [])
+        link = os.path.join(self.folder, "link.mp3")
+        os.link(file, link)
+        inode = os.stat(file).st_ino
+        batch = TagBatch([file], EditSpec(fields={"title": "T" * 4096}))
+        self.assertEqual(batch.write(), {})
+        self.assertEqual(batch.rewrites, 1)
+        self.assertEqual(os.stat(file).st_ino, inode)
+        self.assertEqual(read_tag(link)[0].title, "T" * 4096)
+        self.assertEqual(sorted(os.listdir(self.folder)),
+                         ["file.mp3", "link.mp3"])
+
+    def test_journal_of_another_batch(self):
+        # Files finished by another batch are not skipped when resuming
+        files = [make_file(self.folder, "{}.mp3".format(number), [])
+                 for number in range(3)]
+        path = os.path.join(self.folder, "journal.jsonl")
+        batch = TagBatch(
+            files, EditSpec(fields={"album": "A"}), journal=BatchJournal(path))
+        results = batch.results()
+        next(results)
+        batch.cancel()
+        list(results)
+        batch = TagBatch(
+            files, EditSpec(fields={"album": "B"}), journal=BatchJournal(path))
+        self.assertEqual(batch.write(), {})
+        self.assertEqual(batch.unchanged, 0)
+        for file in files:
+            self.assertEqual(read_tag(file)[0].album, "B")
+        self.assertFalse(os.path.exists(path))
+
+    def test_crash_before_rename(self):
+        # The copy of a rewrite that wasn't renamed yet is removed
+        file = make_file(self.folder, "file.mp3", [])
+        path = os.path.join(self.folder, "journal.jsonl")
+        spec = EditSpec(fields={"title": "T" * 4096})
+        batch = TagBatch([file], spec, journal=BatchJournal(path))
+        with mock.patch("tagbatch.replace_file", side_effect=SystemExit):
+            with self.assertRaises(SystemExit):
+                batch.write()
+        batch.journal.close()
+        self.assertEqual(len(os.listdir(self.folder)), 3)
+        batch = TagBatch([file], spec, journal=BatchJournal(path))
+        self.assertEqual(batch.write(), {})
+        self.assertEqual(read_tag(file)[0].title, "T" * 4096)
+        self.assertEqual(os.listdir(self.folder), ["file.mp3"])
+
+    def test_records_replaced_by_writes(self):
+        # The written tag replaces the record when the stamp is the same,
+        # as on file systems with a coarse mtime
+        file = make_file(self.folder, "file.mp3", [])
+        records = RecordCache()
+        with mock.patch("tagbatch.file_stamp", return_value=(0, 0)):
+            self.assertEqual(records.read(file)[0].album, "")
+            batch = TagBatch(
+                [file], EditSpec(fields={"album": "Album"}), records=records)
+            self.assertEqual(batch.write(), {})
+            self.assertEqual(records.read(file)[0].album, "Album")
+
+    def test_dry_run_metrics(self):
+        # A dry run counts the files, without a write phase
+        files = [make_file(self.folder, "{}.mp3".format(number), [])
+                 for number in range(2)]
+        metrics = BatchMetrics()
+        batch = TagBatch(
+            files, EditSpec(fields={"title": "Title"}), metrics=metrics)
+        self.assertEqual(list(batch.diffs()), [])
+        summary = metrics.summary()
+        self.assertEqual(summary["files"], 2)
+        self.assertEqual(summary["counters"]["unchanged"], 2)
+        self.assertEqual(summary["phases"]["read"]["files"], 2)
+        self.assertEqual(summary["phases"]["write"]["files"], 0)
+
+    def test_records_of_worker_processes(self):
+        # The written tags are kept in the main process, not read again
+        files = [make_file(self.folder, "{}.mp3".format(number), [])
+                 for number in range(3)]
+        records = RecordCache()
+        batch = TagBatch(
+            files,
+            EditSpec(fields={"album": "Album"}),
+            workers=2,
+            executor="process",
+            records=records)
+        self.assertEqual(batch.write(), {})
+        self.assertEqual(sorted(record.file for record in records), files)
+        for record in records:
+            self.assertEqual(record.album, "Album")
+
+    def test_error_reasons(self):
+        # The reason is kept with the error, also from worker processes
+        missing = os.path.join(self.folder, "missing.mp3")
+        metrics = BatchMetrics()
+        batch = TagBatch(
+            [missing, make_file(self.folder, "file.mp3", [])],
+            EditSpec(fields={"album": "Album"}, pattern="{track} - {title}"),
+            workers=2,
+            executor="process",
+            metrics=metrics)
+        errors = batch.write()
+        self.assertEqual(errors[missing].detail, missing)
+        self.assertEqual(metrics.summary()["failures"], {
+            "missing_file": 1, "pattern_mismatch": 1})
+
+
+class TestTagWrites(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.file = make_file(self.folder, "file.mp3", [])
+
+    def write(self, reserve, **values):
+        # Write the values to the tag of the file and check the audio
+        tag = read_tag(self.file)[0]
+        for field, value in values.items():
+            setattr(tag, field, value)
+        rewritten, copied, _ = write_tag(tag, self.file, reserve)
+        with open(self.file, "rb") as f:
+            data = f.read()
+        self.assertEqual(
+            data[tag_length(self.file):], FRAME_HEADER + bytes(SIZES["tiny"]))
+        self.assertEqual(copied, len(FRAME_HEADER) + SIZES["tiny"] if
+                         rewritten else 0)
+        return rewritten
+
+    def test_in_place(self):
+        # A tag that fits in the old one and its padding is written in place
+        self.write(0, title="T" * 2048)
+        length = tag_length(self.file)
+        self.assertFalse(self.write(0, title="Short", album="Album"))
+        self.assertEqual(tag_length(self.file), length)
+        tag = read_tag(self.file)[0]
+        self.assertEqual((tag.title, tag.album), ("Short", "Album"))
+
+    def test_rewrite_with_reserve(self):
+        # A full rewrite adds the reserve, so the next edit fits in place
+        self.assertTrue(self.write(512, title="T" * 2048))
+        length = tag_length(self.file)
+        self.assertFalse(self.write(512, album="A" * 256))
+        self.assertEqual(tag_length(self.file), length)
+        self.assertEqual(read_tag(self.file)[0].album, "A" * 256)
+
+    def test_rewrite_without_reserve(self):
+        # Without a reserve every larger tag needs another rewrite
+        self.assertTrue(self.write(0, title="T" * 2048))
+        self.assertTrue(self.write(0, album="A"))
+        self.assertEqual(read_tag(self.file)[0].title, "T" * 2048)
+
+
+class TestConversion(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+
+    def test_versions_with_dates(self):
+        # Every version converts to the others with the date and frames
+        encoders = {
+            2: stagger.id3.TEN,
+            3: stagger.id3.TENC,
+            4: stagger.id3.TENC}
+        for old in TAG_CLASSES:
+            for new in TAG_CLASSES:
+                if old == new:
+                    continue
+                file = make_file(
+                    self.folder,
+                    "{}-{}.mp3".format(old, new),
+                    [encoders[old](text=["Encoder"])],
+                    old,
+                    artist="Artist",
+                    date="2001-02-03")
+                spec = EditSpec(version=new, keep_obscure=True)
+                self.assertEqual(TagBatch([file], spec).write(), {})
+                tag = read_tag(file)[0]
+                self.assertEqual(tag.version, new)
+                self.assertEqual(
+                    (tag.title, tag.artist, tag.date),
+                    ("Title", "Artist", "2001-02-03"))
+                self.assertIn(encoders[new].frameid, tag._frames)
+
+
+class TestNumbering(unittest.TestCase):
+
+    def test_pattern(self):
+        pattern = PathPattern("{artist}/{album}/{track} - {title}")
+        self.assertEqual(pattern.match("music/Artist/Album/03 - Song.mp3"), {
+            "artist": "Artist", "album": "Album", "track": "03",
+            "title": "Song"})
+        self.assertIsNone(pattern.match("music/Album/Song.mp3"))
+        self.assertRaises(ValueError, PathPattern, "{unknown}")
+        self.assertRaises(ValueError, PathPattern, "{track:>2}")
+
+    def test_padding(self):
+        files = ["{}.mp3".format(number) for number in range(10)]
+        numbers = number_files(files, padding=True)
+        self.assertEqual(numbers["0.mp3"],
+                         {"track": "01", "track_total": 10})
+        self.assertEqual(numbers["9.mp3"]["track"], "10")
+
+    def test_discs_per_group(self):
+        # The groups come from the pattern, the discs from the folders
+        files = ["A/1/x.mp3", "A/1/y.mp3", "A/2/z.mp3", "B/1/w.mp3"]
+        numbers = number_files(
+            files,
+            group="album",
+            discs=True,
+            pattern=PathPattern("{album}/{_}/{title}"))
+        self.assertEqual(numbers["A/1/y.mp3"], {
+            "track": "2", "track_total": 2, "disc": 1, "disc_total": 2})
+        self.assertEqual(numbers["A/2/z.mp3"], {
+            "track": "1", "track_total": 1, "disc": 2, "disc_total": 2})
+        self.assertEqual(numbers["B/1/w.mp3"], {
+            "track": "1", "track_total": 1, "disc": 1, "disc_total": 1})
+
+
+class TestDuplicates(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+
+    @unittest.skipUnless(hasattr(os, "symlink"), "needs symbolic links")
+    def test_same_file(self):
+        file = make_file(self.folder, "file.mp3", [])
+        link = os.path.join(self.folder, "link.mp3")
+        os.symlink(file, link)
+        duplicates = {}
+        self.assertEqual(
+            list(unique_files([file, link], duplicates=duplicates)), [file])
+        self.assertEqual(duplicates, {link: file})
+
+    def test_same_audio(self):
+        # Only the audio is compared, the tags can differ
+        first = make_file(self.folder, "first.mp3", [])
+        copy = make_file(self.folder, "copy.mp3", [], album="Album")
+        other = make_file(self.folder, "other.mp3", [])
+        with open(other, "rb+") as f:
+            f.seek(-1, os.SEEK_END)
+            f.write(b"\x01")
+        files = [first, copy, other]
+        self.assertEqual(list(unique_files(files)), files)
+        duplicates = {}
+        self.assertEqual(
+            list(unique_files(files, "audio", duplicates=duplicates)),
+            [first, other])
+        self.assertEqual(duplicates, {copy: first})
+
+
+class TestScan(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+
+    @unittest.skipUnless(hasattr(os, "symlink"), "needs symbolic links")
+    def test_directory_loop(self):
+        # A link to a parent folder doesn't yield the files again
+        album = os.path.join(self.folder, "album")
+        os.mkdir(album)
+        files = [make_file(album, "{}.mp3".format(number), [])
+                 for number in range(2)]
+        os.symlink("..", os.path.join(album, "loop"))
+        os.symlink("album", os.path.join(self.folder, "link"))
+        self.assertEqual(list(scan_files([self.folder])), files)
+        self.assertEqual(list(scan_files(
+            [album, os.path.join(self.folder, "*")])), files)
+
+
+class TestScheduler(unittest.TestCase):
+
+    def test_limits_per_process(self):
+        # Worker processes together stay within the limits of the batch
+        scheduler = IOScheduler(8, 1000).per_process(4)
+        self.assertEqual(scheduler.max_open, 2)
+        self.assertEqual(scheduler.bytes_per_second, 250)
+        scheduler = IOScheduler(None, 1000).per_process(4)
+        self.assertIsNone(scheduler.max_open)
+
+    def test_order_without_stat(self):
+        # The inodes of the scan are used, other files are sorted by name
+        scheduler = IOScheduler(1)
+        scheduler.inodes.update({"a/2.mp3": 5, "a/3.mp3": 4})
+        files = ["b/1.mp3", "a/2.mp3", "a/3.mp3", "a/1.mp3"]
+        with mock.patch("os.stat", side_effect=AssertionError):
+            self.assertEqual(scheduler.order(files), [
+                "a/1.mp3", "a/3.mp3", "a/2.mp3", "b/1.mp3"])
+        self.assertEqual(scheduler.inodes, {})
+
+
+if __name__ == "__main__":
+    unittest.main()